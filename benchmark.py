@@ -0,0 +1,244 @@
+"""Benchmarks of the pipeline steps over synthetic SVO data
+"""
+
+
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import classifier_features
+
+import experiment
+
+import ncm
+
+import numpy as np
+
+import ontext
+
+
+BENCHMARK_DIR = os.path.expanduser('~/data/ontext_experiments/benchmarks')
+DATETIME_FORMAT = '%Y_%m_%d.%H_%M_%S'
+
+SCALES = ({'triples': 1000, 'instances_per_category': 50,
+           'contexts': 50, 'zipf_skew': 1.1},
+          {'triples': 5000, 'instances_per_category': 200,
+           'contexts': 100, 'zipf_skew': 1.1},
+          {'triples': 20000, 'instances_per_category': 500,
+           'contexts': 200, 'zipf_skew': 1.1})
+
+
+logger = logging.getLogger(__name__)
+
+
+def zipf_probabilities(size, skew):
+    """Probabilities of the ranks 1..size under a Zipf law
+    """
+    weights = 1 / np.arange(1, size + 1) ** skew
+    return weights / weights.sum()
+
+
+def generate_svo(output_dir, triples, instances_per_category,
+                 contexts, zipf_skew=1.1, seed=0):
+    """Writes a synthetic SVO and two category files into output_dir.
+
+    Subjects and objects are drawn from the two categories
+    (in either order) plus as many out-of-category instances;
+    instances and contexts follow a Zipf law of the given skew.
+
+    Returns the paths of the SVO and of the two categories
+    """
+    rng = np.random.RandomState(seed)
+
+    cat1 = np.array([f'cat1_instance_{i}'
+                     for i in range(instances_per_category)])
+    cat2 = np.array([f'cat2_instance_{i}'
+                     for i in range(instances_per_category)])
+    noise = np.array([f'other_instance_{i}'
+                      for i in range(instances_per_category)])
+    verbs = np.array([f'context_{i}' for i in range(contexts)])
+
+    instance_probabilities = zipf_probabilities(instances_per_category,
+                                                zipf_skew)
+    context_probabilities = zipf_probabilities(contexts, zipf_skew)
+
+    def draw(instances, size):
+        return instances[rng.choice(len(instances), size=size,
+                                    p=instance_probabilities)]
+
+    pools = (cat1, cat2, noise)
+    subject_pool = rng.choice(len(pools), size=triples, p=[0.45, 0.45, 0.1])
+    object_pool = np.where(subject_pool == 0, 1, 0)
+    object_pool[rng.random_sample(triples) < 0.1] = 2
+
+    subjects = np.empty(triples, dtype=object)
+    objects = np.empty(triples, dtype=object)
+    for pool_index, pool in enumerate(pools):
+        subject_mask = subject_pool == pool_index
+        subjects[subject_mask] = draw(pool, subject_mask.sum())
+        object_mask = object_pool == pool_index
+        objects[object_mask] = draw(pool, object_mask.sum())
+
+    svo_verbs = verbs[rng.choice(contexts, size=triples,
+                                 p=context_probabilities)]
+    occurrences = rng.geometric(0.3, size=triples)
+
+    svo_path = os.path.join(output_dir, 'svo')
+    with open(svo_path, 'w') as svo:
+        for s, v, o, n in zip(subjects, svo_verbs, objects, occurrences):
+            svo.write(f'{s}\t{v}\t{o}\t{n}\n')
+
+    category_paths = []
+    for name, instances in (('cat1', cat1), ('cat2', cat2)):
+        path = os.path.join(output_dir, name)
+        with open(path, 'w') as category:
+            category.writelines(f'{instance}\n' for instance in instances)
+        category_paths.append(path)
+
+    return svo_path, category_paths[0], category_paths[1]
+
+
+def pipelines(cat1_path, cat2_path):
+    """The step sequences to benchmark.
+
+    Every step in the benchmark is timed,
+    including the ones only needed to feed the others
+    """
+    ncm_steps = (experiment.ReadCategories(cat1_path, cat2_path),
+                 experiment.SvoToMemory(),
+                 ncm.BuildCooccurrenceGraph(),
+                 ncm.Spanner(5),
+                 ncm.NcmHcsw(),
+                 ncm.Medoids(),
+                 ncm.PromotePairs(),
+                 classifier_features.Specifity())
+
+    ontext_steps = (experiment.ReadCategories(cat1_path, cat2_path),
+                    experiment.SvoToMemory(),
+                    ontext.BuildCooccurrenceMatrix(),
+                    ontext.NormalizeMatrix(),
+                    ontext.OntextKmeans(),
+                    classifier_features.Specifity())
+
+    return {'ncm': ncm_steps, 'ontext': ontext_steps}
+
+
+def time_pipeline(steps, svo_path, output_dir, seed=None):
+    """Seconds taken by each step of the pipeline,
+    its randomised steps seeded with seed
+    """
+    exp = experiment.Experiment(output_dir, None, steps=steps, seed=seed)
+    exp.add_file('raw_svo', svo_path)
+    exp.add_file('svo', svo_path)
+    exp.prepare()
+
+    timings = {}
+    for step in steps:
+        start = time.perf_counter()
+        exp.execute_step()
+        timings[str(step)] = time.perf_counter() - start
+
+    return timings
+
+
+def run_benchmarks(scales=SCALES, repeat=3, seed=0):
+    """Times every pipeline at every scale.
+
+    Keeps the best time of the repetitions of each step;
+    seed fixes both the generated data and the randomised steps
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scale_index, scale in enumerate(scales):
+            data_dir = os.path.join(work_dir, f'data_{scale_index}')
+            os.makedirs(data_dir)
+            svo_path, cat1_path, cat2_path = generate_svo(data_dir,
+                                                          seed=seed,
+                                                          **scale)
+
+            for name, steps in pipelines(cat1_path, cat2_path).items():
+                logger.info(f'Benchmarking {name} at {scale}')
+                best = {}
+                for repetition in range(repeat):
+                    output_dir = os.path.join(work_dir, name)
+                    timings = time_pipeline(steps, svo_path, output_dir,
+                                            seed=seed)
+                    for step_name, seconds in timings.items():
+                        best[step_name] = min(seconds,
+                                              best.get(step_name, seconds))
+
+                results.append({'pipeline': name,
+                                'scale': scale,
+                                'timings': best})
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output_path=None):
+    """Writes the results as JSON, together with the
+    revision and environment they were measured on
+    """
+    now = datetime.datetime.now().strftime(DATETIME_FORMAT)
+    revision = git_revision()
+
+    if output_path is None:
+        os.makedirs(BENCHMARK_DIR, exist_ok=True)
+        filename = f'{now}.{(revision or "unknown")[:10]}.json'
+        output_path = os.path.join(BENCHMARK_DIR, filename)
+
+    document = {'revision': revision,
+                'datetime': now,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results}
+
+    with open(output_path, 'w') as output_handle:
+        json.dump(document, output_handle, indent=2)
+
+    return output_path
+
+
+def compare(baseline_path, candidate_path):
+    """Ratio candidate/baseline of the time of each step
+    measured in both files (lower is better)
+    """
+    def load(path):
+        with open(path) as handle:
+            document = json.load(handle)
+        return {(r['pipeline'], json.dumps(r['scale'], sort_keys=True),
+                 step_name): seconds
+                for r in document['results']
+                for step_name, seconds in r['timings'].items()}
+
+    baseline = load(baseline_path)
+    candidate = load(candidate_path)
+
+    return {key: candidate[key] / baseline[key]
+            for key in sorted(baseline.keys() & candidate.keys())
+            if baseline[key] > 0}
+
+
+def main(scales=SCALES, repeat=3, seed=0, output_path=None):
+    logging.basicConfig(level=logging.INFO)
+    results = run_benchmarks(scales, repeat=repeat, seed=seed)
+    return save_results(results, output_path)
+
+
+if __name__ == '__main__':
+    print(main())
@@ -0,0 +1,132 @@
+"""Category instances loaded once and shared between category pairs
+"""
+
+
+import logging
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class InstanceVocabulary:
+    """Interns instance names into global integer ids.
+
+    The same vocabulary is meant to be shared by everything
+    encoding instances (categories, SVO readers),
+    so ids are comparable everywhere
+    """
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def intern(self, name):
+        """Id of the name, assigning a new one if unknown
+        """
+        instance_id = self._ids.get(name)
+        if instance_id is None:
+            instance_id = len(self._names)
+            self._ids[name] = instance_id
+            self._names.append(name)
+        return instance_id
+
+    def lookup(self, names):
+        """Ids of the names as an array, -1 for unknown names
+        """
+        ids = self._ids
+        return np.fromiter((ids.get(name, -1) for name in names),
+                           dtype=np.int64)
+
+    def name(self, instance_id):
+        return self._names[instance_id]
+
+    def names(self, instance_ids):
+        return [self._names[instance_id] for instance_id in instance_ids]
+
+
+class CategoryStore:
+    """Instances of the categories in category_dir,
+    each category read from disk only once.
+
+    Instance names are shared between categories
+    (one string object per instance), and each category
+    is also kept as a sorted array of vocabulary ids
+    """
+    def __init__(self, category_dir, vocabulary=None):
+        self.category_dir = os.path.expanduser(category_dir)
+        if vocabulary is None:
+            vocabulary = InstanceVocabulary()
+        self.vocabulary = vocabulary
+        self._names = {}
+        self._ids = {}
+
+    def __contains__(self, category):
+        return category in self._ids
+
+    def categories(self):
+        return sorted(self._ids)
+
+    def load(self, category):
+        if category in self._ids:
+            return
+
+        path = os.path.join(self.category_dir, category)
+        logger.debug(f'Loading category {category} from {path}')
+
+        ids = set()
+        with open(path) as entries:
+            for entry in entries:
+                ids.add(self.vocabulary.intern(entry.strip()))
+
+        self._ids[category] = np.array(sorted(ids), dtype=np.int64)
+        self._names[category] = frozenset(self.vocabulary.names(ids))
+
+    def load_all(self):
+        """Loads every category file in category_dir
+        """
+        for category in sorted(os.listdir(self.category_dir)):
+            self.load(category)
+
+    def names(self, category):
+        """The instances of the category, as a frozenset of names
+        """
+        self.load(category)
+        return self._names[category]
+
+    def ids(self, category):
+        """The instances of the category, as a sorted array of ids
+        """
+        self.load(category)
+        return self._ids[category]
+
+    def contains(self, category, instance_ids):
+        """Vectorised membership: boolean mask of which
+        of the instance ids belong to the category
+        """
+        category_ids = self.ids(category)
+        instance_ids = np.asarray(instance_ids)
+        if len(category_ids) == 0:
+            return np.zeros(instance_ids.shape, dtype=bool)
+
+        positions = np.searchsorted(category_ids, instance_ids)
+        positions[positions == len(category_ids)] = 0
+        return category_ids[positions] == instance_ids
+
+    def bitmap(self, category, size=None):
+        """The category as a boolean array indexed by instance id
+        (sized to the current vocabulary by default)
+        """
+        if size is None:
+            size = len(self.vocabulary)
+        bitmap = np.zeros(size, dtype=bool)
+        category_ids = self.ids(category)
+        bitmap[category_ids[category_ids < size]] = True
+        return bitmap
@@ -2,8 +2,12 @@ import os
 from collections import defaultdict
 from operator import itemgetter
 
+import numpy as np
+
 import pandas as pd
 
+import svo_io
+
 
 class InstanceFrequencyCount:
     """Returns the mean of the frequency
@@ -15,7 +19,8 @@ class InstanceFrequencyCount:
     require both S and O to be each of
     one category.
     """
-    def __init__(self, cache=False):
+    def __init__(self, chunk_size=svo_io.LINES_PER_CHUNK, cache=False):
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
@@ -67,25 +72,24 @@ class InstanceFrequencyCount:
                 'mean_instance_frequency_cat2': mean2}
 
     def count(self, svo, instances):
-        counter = defaultdict(lambda: 0)
+        counts = []
+        for s, v, o, n in svo_io.read_chunks(svo, self.chunk_size):
+            for column in (s, o):
+                found = svo_io.isin(column, instances)
+                counts.append(pd.Series(n[found], index=column[found]))
 
-        with open(svo) as svo_contents:
-            for line in svo_contents:
-                s, v, o, n = line.split('\t')
-
-                if s in instances:
-                    counter[s] += int(n)
-                if o in instances:
-                    counter[o] += int(n)
-
-        return counter
+        if not counts:
+            return {}
+        counter = pd.concat(counts).groupby(level=0, sort=False).sum()
+        return dict(zip(counter.index, counter.tolist()))
 
 
 class Specifity:
     """Feature calculating how specific the relation
     is to the category pair in question
     """
-    def __init__(self, cache=False):
+    def __init__(self, chunk_size=svo_io.LINES_PER_CHUNK, cache=False):
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
@@ -107,30 +111,31 @@ class Specifity:
         return ['relation_specifity_df']
 
     def apply(self, raw_svo, cat1, cat2, relation_names, **kwargs):
-        counter = {}
-        for relation in relation_names:
-            counter[relation] = {'cat1_unspecific': 0,
-                                 'cat2_unspecific': 0,
-                                 'cooccurrence_count': 0,
-                                 'cooccurrence_count_question': 0}
-
-        with open(raw_svo) as svo_contents:
-            for line in svo_contents:
-                s, v, o, n = line.split('\t')
-                for relation in relation_names:
-                    if v == relation:
-                        if s in cat1:
-                            if o in cat2:
-                                counter[v]['cooccurrence_count'] += 1
-                            else:
-                                counter[v]['cat1_unspecific'] += 1
-                        elif o in cat1:
-                            if s in cat2:
-                                counter[v]['cat2_unspecific'] += 1
-                            else:
-                                counter[v]['cooccurrence_count_question'] += 1
-
-        return {'relation_specifity_df': pd.DataFrame(counter).T}
+        columns = ['cat1_unspecific', 'cat2_unspecific',
+                   'cooccurrence_count', 'cooccurrence_count_question']
+        counter = pd.DataFrame(0, index=pd.Index(relation_names).unique(),
+                               columns=columns)
+
+        for s, v, o, n in svo_io.read_chunks(raw_svo, self.chunk_size):
+            relation = svo_io.isin(v, counter.index)
+            s, v, o = s[relation], v[relation], o[relation]
+
+            s_in_cat1 = svo_io.isin(s, cat1)
+            o_in_cat1 = ~s_in_cat1 & svo_io.isin(o, cat1)
+            o_in_cat2 = svo_io.isin(o, cat2)
+            s_in_cat2 = svo_io.isin(s, cat2)
+
+            chunk_counts = pd.DataFrame(
+                {'cat1_unspecific': s_in_cat1 & ~o_in_cat2,
+                 'cat2_unspecific': o_in_cat1 & s_in_cat2,
+                 'cooccurrence_count': s_in_cat1 & o_in_cat2,
+                 'cooccurrence_count_question': o_in_cat1 & ~s_in_cat2},
+                dtype=np.int64).groupby(v).sum()
+            counter = counter.add(chunk_counts, fill_value=0)
+
+        counter = counter.reindex(index=pd.Index(relation_names).unique(),
+                                  columns=columns).astype(np.int64)
+        return {'relation_specifity_df': counter}
 
 
 class PatternContextSize:
@@ -243,6 +248,10 @@ class RelationshipCharacteristics:
 
 
 class FeatureAggregator:
+    df_names = ['pattern_context_size_df',
+                'commonest_instances_frequencies',
+                'pattern_specifity_df']
+
     def __init__(self, *, save_output=False, cache=False):
         self.save_output = save_output
         self.cache = cache
@@ -259,6 +268,9 @@ class FeatureAggregator:
     def required_data(self):
         return ['relation_names']
 
+    def optional_data(self):
+        return self.df_names
+
     def creates(self):
         if self.save_output:
             return ['classifier_data']
@@ -270,10 +282,7 @@ class FeatureAggregator:
     def apply(self, relation_names, output_dir, **kwargs):
         current = pd.DataFrame(index=relation_names)
 
-        df_names = ['pattern_context_size_df',
-                    'commonest_instances_frequencies',
-                    'pattern_specifity_df']
-        for df_name in df_names:
+        for df_name in self.df_names:
             if df_name in kwargs:
                 current = current.join(kwargs[df_name])
 
@@ -0,0 +1,192 @@
+"""Counting of keys, exactly or in bounded memory
+"""
+
+
+import logging
+
+import numpy as np
+
+
+COUNTING_MODES = ('exact', 'hashed', 'sketch')
+MERGE_SIZE = 1 << 22
+MERGE_CHUNKS = 16
+PAIR_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+logger = logging.getLogger(__name__)
+
+
+def hash_strings(values):
+    """64-bit hashes of the strings, as an uint64 array
+    """
+    import pandas as pd
+
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def hash_unordered_pairs(first, second):
+    """64-bit hashes of the pairs of strings,
+    the same for (a, b) and (b, a)
+    """
+    first = hash_strings(first)
+    second = hash_strings(second)
+    low = np.minimum(first, second)
+    high = np.maximum(first, second)
+    return (low * PAIR_MULTIPLIER) ^ high
+
+
+def counter(mode, sketch_width=None):
+    """A new counter for the counting mode:
+    'exact' counts any keys, 'hashed' and 'sketch' count 64-bit hashes
+    """
+    if mode == 'exact':
+        return ValueCounter()
+    if mode == 'hashed':
+        return HashCounter()
+    if mode == 'sketch':
+        if sketch_width is None:
+            return CountMinSketch()
+        return CountMinSketch(width=sketch_width)
+    raise ValueError(f'Unknown counting mode {mode}')
+
+
+class ValueCounter:
+    """Exact counts of any keys (such as strings), in a pandas Series
+    indexed by key (pandas being imported on first use).
+    Counts of chunks are merged every few chunks
+    """
+    def __init__(self):
+        import pandas as pd
+
+        self.counts = pd.Series([], dtype=np.int64)
+        self._pending = []
+
+    def __len__(self):
+        self._merge()
+        return len(self.counts)
+
+    def add(self, keys):
+        import pandas as pd
+
+        self._pending.append(pd.Series(keys).value_counts(sort=False))
+        if len(self._pending) >= MERGE_CHUNKS:
+            self._merge()
+
+    def counts_of(self, keys):
+        """Count of each of the keys, 0 for keys never added
+        """
+        import pandas as pd
+
+        self._merge()
+        return (pd.Series(keys).map(self.counts)
+                               .fillna(0)
+                               .to_numpy(dtype=np.int64))
+
+    def _merge(self):
+        if not self._pending:
+            return
+
+        import pandas as pd
+
+        self.counts = (pd.concat([self.counts] + self._pending)
+                         .groupby(level=0, sort=False)
+                         .sum())
+        self._pending = []
+
+
+class HashCounter:
+    """Exact counts of 64-bit keys, kept as a sorted array
+    of the distinct keys and an array of their counts
+    (16 bytes per key, instead of a Python object per key).
+
+    Added keys are buffered and merged into the arrays
+    once the buffer outgrows them
+    """
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self):
+        self._merge()
+        return len(self.keys)
+
+    def add(self, keys):
+        self._pending.append(np.asarray(keys, dtype=np.uint64))
+        self._pending_size += len(keys)
+        if self._pending_size >= max(len(self.keys), MERGE_SIZE):
+            self._merge()
+
+    def counts_of(self, keys):
+        """Count of each of the keys, 0 for keys never added
+        """
+        self._merge()
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.int64)
+
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == len(self.keys)] = 0
+        found = self.keys[positions] == keys
+        return np.where(found, self.counts[positions], 0)
+
+    def _merge(self):
+        if not self._pending:
+            return
+
+        keys, counts = np.unique(np.concatenate(self._pending),
+                                 return_counts=True)
+        self._pending = []
+        self._pending_size = 0
+
+        self.keys, inverse = np.unique(np.concatenate([self.keys, keys]),
+                                       return_inverse=True)
+        self.counts = np.bincount(inverse,
+                                  weights=np.concatenate([self.counts,
+                                                          counts]),
+                                  minlength=len(self.keys)).astype(np.int64)
+
+
+class CountMinSketch:
+    """Approximate counts of 64-bit keys in fixed memory
+    (depth rows of width counters).
+
+    An estimate is never below the true count, and exceeds it
+    by more than e / width times the total count with
+    probability at most exp(-depth); so a threshold filter
+    using it keeps every key it should, and a few more
+    """
+    def __init__(self, width=1 << 22, depth=4, seed=0):
+        if width <= 0 or width & (width - 1):
+            raise ValueError('width must be a power of two')
+        if depth <= 0:
+            raise ValueError('depth must be positive')
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self._shift = np.uint64(64 - width.bit_length() + 1)
+        # odd multipliers for multiply-shift hashing, one per row
+        rng = np.random.default_rng(seed)
+        self._multipliers = (rng.integers(0, 1 << 63, size=depth,
+                                          dtype=np.uint64) << np.uint64(1)
+                             | np.uint64(1))
+
+    def add(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        for row, multiplier in enumerate(self._multipliers):
+            self.table[row] += np.bincount(self._columns(keys, multiplier),
+                                           minlength=self.width
+                                           ).astype(np.uint32)
+
+    def counts_of(self, keys):
+        """Estimated count of each of the keys
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        estimates = [self.table[row][self._columns(keys, multiplier)]
+                     for row, multiplier in enumerate(self._multipliers)]
+        return np.min(estimates, axis=0).astype(np.int64)
+
+    def _columns(self, keys, multiplier):
+        if self.width == 1:
+            return np.zeros(len(keys), dtype=np.int64)
+        return ((keys * multiplier) >> self._shift).astype(np.int64)
@@ -4,11 +4,24 @@
 
 import logging
 import os
+import pickle
 import shutil
 from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import numpy as np
 
+import ondisk
+
+import profiling
+
+import progress
+
+import shared_arrays
+
+import svo_io
+
 
 logger = logging.getLogger(__name__)
 
@@ -16,10 +29,48 @@ logger = logging.getLogger(__name__)
 class Experiment:
     """Manages the state of a running experiment
     """
-    def __init__(self, output_dir, cache_dir, steps, prefix=''):
+    def __init__(self, output_dir, cache_dir, steps, prefix='',
+                 profile_steps=None, profiler='cprofile',
+                 release_data=None, keep_data=(), share_arrays=False,
+                 seed=None, reporter=None, memory_budget=None):
         """The prefix is used to identify the cache step;
         it should be used to guide the cache w.r.t. the base files
+
+        profile_steps is a collection of step names (either the str
+        of the step or its class name, '*' for all steps) whose
+        execution is profiled with the named profiler
+        ('cprofile' or 'sampling'); the profile is dumped in the
+        output directory of the step
+
+        release_data frees the data produced by the steps as soon as
+        every step reading it has finished: 'drop' deletes it, 'spill'
+        pickles it to disk, to be loaded back only when accessed;
+        None keeps everything in memory. Data named in keep_data,
+        and data no step reads (the results), is never released
+
+        share_arrays moves the NumPy arrays returned by the steps
+        to shared memory, see shared_handles; close (or leaving
+        the experiment as a context manager) unlinks them
+        once no more workers need to attach
+
+        seed is given to every step with a seed attribute left as None
+        (randomised steps include their seed in their str,
+        so it is part of the cache key)
+
+        reporter is a progress.ProgressReporter
+        told about every step run (None reports nothing)
+
+        memory_budget (bytes) is given to every step; steps whose
+        large structures are estimated to exceed it keep them on disk
+        (see ondisk), finishing slower instead of running out of memory.
+        None never spills
         """
+        if profiler not in profiling.PROFILERS:
+            raise ValueError(f'Unknown profiler {profiler}')
+        if release_data not in (None, 'drop', 'spill'):
+            raise ValueError(f'Unknown release_data {release_data}')
+        if memory_budget is not None and memory_budget <= 0:
+            raise ValueError(f'Invalid memory_budget {memory_budget}')
         self.output_dir = os.path.expanduser(output_dir)
         if cache_dir is not None:
             self.cache_dir = os.path.expanduser(cache_dir)
@@ -27,17 +78,46 @@ class Experiment:
             self.cache_dir = None
         self._steps = tuple(steps)
         self._executed_steps = []
-        self._pending_execution = list(reversed(self._steps))
+        self._pending_execution = list(reversed(range(len(self._steps))))
+        self._dependencies = None
+        self._cache_strings = None
+        self._pending_readers = None
         self.files = {}
-        self.data = {}
+        self.data = DataStore()
         self.prefix = prefix
+        self.profile_steps = profile_steps
+        self.profiler = profiler
+        self.release_data = release_data
+        self.keep_data = set(keep_data)
+        if share_arrays:
+            self.shared = shared_arrays.SharedArrayRegistry()
+        else:
+            self.shared = None
+        self.reporter = reporter
+        self.memory_budget = memory_budget
+        self.seed = seed
+        if seed is not None:
+            for step in self._steps:
+                if getattr(step, 'seed', 0) is None:
+                    step.seed = seed
 
     def add_file(self, name, path):
         self.files[name] = os.path.expanduser(path)
 
     def prepare(self):
         """Reads the cache and creates directory structure
+
+        Also checks the inputs and outputs declared by the steps,
+        raising ValueError if some input is never made available
+        or if some output is produced twice
         """
+        self._dependencies = self.build_dependencies()
+        self._pending_readers = self.data_readers()
+        if self.reporter is not None:
+            self.reporter.begin_experiment(
+                [str(self._steps[index])
+                 for index in reversed(self._pending_execution)])
+
         if self.cache_dir is not None:
             cache_filenames = set(os.listdir(self.cache_dir))
         else:
@@ -46,6 +126,7 @@ class Experiment:
         # creates a directory for each step.
         # if the output of a step is in the cache,
         # then creates a symbolic link to the cache
+        self._cache_strings = []
         execution_string = self.prefix + '.'
         for step in self._steps:
             path = os.path.join(self.output_dir, str(step))
@@ -56,21 +137,104 @@ class Experiment:
             logger.debug(f'Creating directory {path}')
             os.makedirs(path)
             execution_string += str(step)
+            self._cache_strings.append(execution_string)
             for step_output in step.creates():
                 cache_file = execution_string + '.' + step_output
                 logger.debug(f'Checking for cache file {cache_file}')
-                if cache_file in cache_filenames:
+                if cache_file not in cache_filenames:
+                    continue
+                src = os.path.join(os.path.expanduser(self.cache_dir),
+                                   cache_file)
+                # entries whose output (or the physical SVO
+                # of a selection) was deleted are cache misses
+                if svo_io.is_available(src):
                     logger.debug(f'Linking cache file {cache_file}')
-                    src = os.path.join(os.path.expanduser(self.cache_dir),
-                                       execution_string + '.' + step_output)
                     os.symlink(src, os.path.join(path, step_output))
             execution_string += '.'
 
+    def build_dependencies(self):
+        """For each step, the set of indexes of the steps
+        it must wait for.
+
+        A step waits for the steps producing its inputs,
+        and a step overwriting a file or data waits
+        for every step reading the previous version
+        """
+        available = ({('file', name) for name in self.files}
+                     | {('data', name) for name in self.data})
+        last_writer = {}
+        readers = defaultdict(list)
+        dependencies = []
+
+        for index, step in enumerate(self._steps):
+            reads = ([('file', name) for name in step.required_files()]
+                     + [('data', name) for name in step.required_data()])
+            optional_reads = [('data', name)
+                              for name in optional_data(step)]
+            writes = ([('file', name) for name in step.creates()]
+                      + [('data', name) for name in step.returns()])
+            step_dependencies = set()
+
+            for kind, name in reads:
+                if (kind, name) in last_writer:
+                    step_dependencies.add(last_writer[kind, name])
+                elif (kind, name) not in available:
+                    raise ValueError(f'Missing {kind} {name}'
+                                     f' for step {step}')
+
+            for resource in optional_reads:
+                if resource in last_writer:
+                    step_dependencies.add(last_writer[resource])
+
+            for kind, name in writes:
+                produced = ((kind, name) in last_writer
+                            or (kind, name) in available)
+                if produced and (kind, name) not in reads:
+                    raise ValueError(f'{kind} {name} produced twice,'
+                                     f' again by step {step}')
+                if (kind, name) in last_writer:
+                    step_dependencies.add(last_writer[kind, name])
+                step_dependencies.update(readers[kind, name])
+
+            for resource in reads + optional_reads:
+                readers[resource].append(index)
+            for resource in writes:
+                last_writer[resource] = index
+                readers[resource] = []
+
+            step_dependencies.discard(index)
+            dependencies.append(step_dependencies)
+
+        return dependencies
+
+    def data_readers(self):
+        """Maps each data produced by the steps
+        to the indexes of the steps reading it
+        """
+        produced = {name for step in self._steps for name in step.returns()}
+        readers = defaultdict(set)
+
+        for index, step in enumerate(self._steps):
+            for name in list(step.required_data()) + optional_data(step):
+                if name in produced:
+                    readers[name].add(index)
+
+        return readers
+
     def steps_pending(self):
         """Returns the amount of steps pending execution
         """
         return len(self._pending_execution)
 
+    def should_profile(self, step):
+        """Whether the execution of the step must be profiled
+        """
+        if not self.profile_steps:
+            return False
+        return ('*' in self.profile_steps
+                or str(step) in self.profile_steps
+                or type(step).__name__ in self.profile_steps)
+
     def executed_string(self):
         """Returns the string of the executed steps so far,
         used for caching results
@@ -84,9 +248,64 @@ class Experiment:
         if self.steps_pending() == 0:
             raise ValueError('No steps left to execute')
 
-        current_step = self._pending_execution.pop()
+        index = self._pending_execution.pop()
+        new_data = self._run_step(index, self._step_arguments(index))
+        self._finish_step(index, new_data)
+
+    def execute_all(self, workers=1):
+        """Executes all pending steps.
+
+        With more than one worker, steps run in a thread pool
+        as soon as the steps they depend on are finished
+        """
+        if workers <= 1:
+            while self.steps_pending() > 0:
+                self.execute_step()
+            return
+
+        if self._dependencies is None:
+            self._dependencies = self.build_dependencies()
+
+        finished = set(range(len(self._steps))) - set(self._pending_execution)
+        running = {}
+
+        with ThreadPoolExecutor(workers) as executor:
+            while self._pending_execution or running:
+                ready = [index for index in reversed(self._pending_execution)
+                         if self._dependencies[index] <= finished]
+                for index in ready:
+                    self._pending_execution.remove(index)
+                    future = executor.submit(self._run_step, index,
+                                             self._step_arguments(index))
+                    running[future] = index
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    self._finish_step(index, future.result())
+                    finished.add(index)
+
+    def _step_arguments(self, index):
+        step = self._steps[index]
+        step_output_dir = os.path.join(self.output_dir, str(step))
+
+        # spilled data is only loaded back if the step declares it
+        data = self.data.resident()
+        for name in list(step.required_data()) + optional_data(step):
+            if name in self.data and name not in data:
+                data[name] = self.data[name]
+
+        return {**self.files, **data, 'output_dir': step_output_dir,
+                'memory_budget': self.memory_budget}
+
+    def _run_step(self, index, args):
+        """Applies the step, unless its outputs are all cached.
+
+        Returns the new data, or None
+        """
+        current_step = self._steps[index]
         cache = current_step.cache
-        step_output_dir = os.path.join(self.output_dir, str(current_step))
+        step_output_dir = args['output_dir']
 
         logger.debug(f'Preparing step {str(current_step)}')
 
@@ -102,46 +321,218 @@ class Experiment:
                       f'Intended outputs {intended_outputs} | '
                       f'Creates mem obj {creates_memory_objects}'))
 
-        if creates_memory_objects or intended_outputs > saved_outputs:
-            logging.debug(f'Executing step {str(current_step)}')
-            for required_file in current_step.required_files():
-                if required_file not in self.files:
-                    raise ValueError(f'Missing file {required_file}'
-                                     f'for step {current_step}')
-            for required_data in current_step.required_data():
-                if required_data not in self.data:
-                    raise ValueError(f'Missing data {required_data}'
-                                     f'for step {current_step}')
-
-            args = {**self.files, **self.data, 'output_dir': step_output_dir}
-            new_data = current_step.apply(**args)
-
-            if new_data is not None:
-                self.data.update(new_data)
-        else:
+        if not creates_memory_objects and intended_outputs <= saved_outputs:
             logging.debug(f'Step {str(current_step)} skipped, using cache')
+            if self.reporter is not None:
+                self.reporter.skip_step(str(current_step))
+            return None
+
+        logging.debug(f'Executing step {str(current_step)}')
+        for required_file in current_step.required_files():
+            if required_file not in self.files:
+                raise ValueError(f'Missing file {required_file}'
+                                 f' for step {current_step}')
+        for required_data in current_step.required_data():
+            if required_data not in self.data:
+                raise ValueError(f'Missing data {required_data}'
+                                 f' for step {current_step}')
+
+        with progress.step_context(self.reporter, str(current_step)):
+            if self.should_profile(current_step):
+                profile_path = os.path.join(step_output_dir, 'profile')
+                return profiling.profiled_call(self.profiler,
+                                               profile_path,
+                                               current_step.apply,
+                                               **args)
+
+            return current_step.apply(**args)
+
+    def _finish_step(self, index, new_data):
+        """Registers the outputs of an executed step
+        """
+        current_step = self._steps[index]
+        step_output_dir = os.path.join(self.output_dir, str(current_step))
+
+        if new_data is not None:
+            self.data.update(new_data)
+            if self.shared is not None:
+                self._share_arrays(new_data)
 
         self._executed_steps.append(current_step)
         for new_file in current_step.creates():
             new_path = os.path.join(step_output_dir, new_file)
             self.files[new_file] = new_path
-            if cache:
-                cache_filename = self.executed_string() + '.' + new_file
+            if current_step.cache and self.cache_dir is not None:
+                cache_filename = self._cache_string(index) + '.' + new_file
                 cache_path = os.path.join(self.cache_dir, cache_filename)
                 if not os.path.exists(cache_path):
+                    if os.path.islink(cache_path):
+                        os.remove(cache_path)
                     os.symlink(os.path.expanduser(new_path), cache_path)
 
-    def execute_all(self):
-        while self.steps_pending() > 0:
-            self.execute_step()
+        if self.release_data is not None and self._pending_readers:
+            self._release_dead_data(index)
+
+    def _release_dead_data(self, index):
+        """Releases the data no pending step is going to read
+        """
+        for name, readers in list(self._pending_readers.items()):
+            readers.discard(index)
+            if readers:
+                continue
+            del self._pending_readers[name]
+            if name in self.keep_data or name not in self.data:
+                continue
+
+            if self.release_data == 'spill':
+                spill_dir = os.path.join(self.output_dir, 'spilled_data')
+                os.makedirs(spill_dir, exist_ok=True)
+                path = os.path.join(spill_dir, f'{name}.pickle')
+                logger.debug(f'Spilling data {name} to {path}')
+                self.data.spill(name, path)
+            else:
+                logger.debug(f'Releasing data {name}')
+                del self.data[name]
+
+            if self.shared is not None and name in self.shared:
+                self.shared.unpublish(name)
+
+    def _share_arrays(self, new_data):
+        for name, value in new_data.items():
+            if shared_arrays.shareable(value):
+                self.data[name] = self.shared.publish(name, value)
+            elif name in self.shared:
+                self.shared.unpublish(name)
+
+    def shared_handles(self, names=None):
+        """Picklable handles of the data in shared memory
+        (all of it, or only the given names), for worker processes
+        to attach to with shared_arrays.attach
+        """
+        if self.shared is None:
+            raise ValueError('Experiment is not sharing arrays')
+        if names is None:
+            return dict(self.shared.handles)
+        return {name: self.shared.handles[name] for name in names}
+
+    def close(self):
+        """Unlinks the shared memory of the experiment;
+        the arrays stay valid in this process until freed
+        """
+        if self.shared is not None:
+            self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def cache_status(self):
+        """Pairs of each step and whether all its outputs are
+        in the cache (as prepare would find them)
+        """
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            cache_filenames = set(os.listdir(self.cache_dir))
+        else:
+            cache_filenames = set()
+
+        def in_cache(cache_file):
+            return (cache_file in cache_filenames
+                    and svo_io.is_available(os.path.join(self.cache_dir,
+                                                         cache_file)))
+
+        status = []
+        for index, step in enumerate(self._steps):
+            outputs = step.creates()
+            cache_string = self._cache_string(index)
+            cached = (step.cache and len(outputs) > 0
+                      and all(in_cache(f'{cache_string}.{output}')
+                              for output in outputs))
+            status.append((step, cached))
+        return status
+
+    def _cache_string(self, index):
+        """The cache identifier of the step outputs,
+        independent of the order steps actually finished in
+        """
+        if self._cache_strings is not None:
+            return self._cache_strings[index]
+        step_names = '.'.join(str(step) for step in self._steps[:index + 1])
+        return self.prefix + '.' + step_names
+
+
+class DataStore(MutableMapping):
+    """Data of the experiment, either resident in memory
+    or spilled to disk and loaded back when accessed
+    """
+    def __init__(self):
+        self._resident = {}
+        self._spilled = {}
+
+    def __getitem__(self, key):
+        if key in self._resident:
+            return self._resident[key]
+        with open(self._spilled[key], 'rb') as spilled:
+            logger.debug(f'Loading spilled data {key}')
+            return pickle.load(spilled)
+
+    def __setitem__(self, key, value):
+        self._spilled.pop(key, None)
+        self._resident[key] = value
+
+    def __delitem__(self, key):
+        if key in self._resident:
+            del self._resident[key]
+        else:
+            del self._spilled[key]
+
+    def __iter__(self):
+        yield from self._resident
+        yield from self._spilled
+
+    def __len__(self):
+        return len(self._resident) + len(self._spilled)
+
+    def resident(self):
+        """Copy of the data currently held in memory
+        """
+        return dict(self._resident)
+
+    def spill(self, key, path):
+        """Writes the data to path and frees it from memory;
+        unpicklable data is kept in memory
+        """
+        try:
+            with open(path, 'wb') as spilled:
+                pickle.dump(self._resident[key], spilled,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            logger.warning(f'Could not spill data {key}, keeping it: {e}')
+            return
+        del self._resident[key]
+        self._spilled[key] = path
+
+
+def optional_data(step):
+    """Data the step reads if available, without requiring it
+    """
+    if hasattr(step, 'optional_data'):
+        return list(step.optional_data())
+    return []
 
 
 class ReadCategories:
-    def __init__(self, path1, path2, cache=False):
+    def __init__(self, path1, path2, store=None, cache=False):
+        """With a category_store.CategoryStore, the categories
+        are taken from the store (by the file names of the paths),
+        shared with every other pair using it
+        """
         self.path1 = path1
         self.category1 = os.path.basename(path1)
         self.path2 = path2
         self.category2 = os.path.basename(path2)
+        self.store = store
         self.cache = cache
 
     def __repr__(self):
@@ -163,6 +554,10 @@ class ReadCategories:
         return ['cat1', 'cat2']
 
     def apply(self, **kwargs):
+        if self.store is not None:
+            return {'cat1': self.store.names(self.category1),
+                    'cat2': self.store.names(self.category2)}
+
         return {'cat1': set(self.load(self.path1)),
                 'cat2': set(self.load(self.path2))}
 
@@ -172,11 +567,45 @@ class ReadCategories:
                 yield entry.strip()
 
 
+def extend_groups(groups, keys, *columns):
+    """Appends the rows (tuples of the columns) to the list
+    of their key in groups, keys being a pandas Index.
+
+    Rows are grouped in NumPy; keys keep the order
+    of their first row, and each group the order of its rows.
+    groups is a defaultdict(list) or an ondisk.DiskMultimap
+    """
+    codes, uniques = keys.factorize()
+    order = np.argsort(codes, kind='stable')
+    rows = list(zip(*(np.asarray(column)[order].tolist()
+                      for column in columns)))
+    ends = np.cumsum(np.bincount(codes, minlength=len(uniques))).tolist()
+
+    if isinstance(groups, ondisk.DiskMultimap):
+        extend = groups.extend
+    else:
+        def extend(key, values):
+            groups[key].extend(values)
+
+    start = 0
+    for key, end in zip(uniques, ends):
+        extend(key, rows[start:end])
+        start = end
+
+
 class SvoToMemory:
     """After the SVO has been preprocessed,
-    load the remaining values into memory indexes
+    load the remaining values into memory indexes,
+    a chunk of chunk_size lines at a time.
+
+    When the indexes are estimated (at ROW_BYTES per line) to exceed
+    the memory budget, pair_to_contexts and contexts_to_pairs are
+    ondisk.DiskMultimap files in the output directory instead
     """
-    def __init__(self, cache=False):
+    ROW_BYTES = 400
+
+    def __init__(self, chunk_size=svo_io.LINES_PER_CHUNK, cache=False):
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
@@ -197,21 +626,33 @@ class SvoToMemory:
     def returns(self):
         return ['pair_to_contexts', 'contexts_to_pairs', 'unique_contexts']
 
-    def apply(self, svo, **kwargs):
-        pair_to_contexts = defaultdict(lambda: [])
-        contexts_to_pairs = defaultdict(lambda: [])
+    def apply(self, svo, output_dir=None, memory_budget=None, **kwargs):
+        estimate = 0
+        if memory_budget is not None:
+            estimate = svo_io.estimate_lines(svo) * self.ROW_BYTES
+        if ondisk.exceeds_budget(estimate, memory_budget, 'The SVO indexes'):
+            pair_to_contexts = ondisk.DiskMultimap(
+                os.path.join(output_dir, 'pair_to_contexts.sqlite'))
+            contexts_to_pairs = ondisk.DiskMultimap(
+                os.path.join(output_dir, 'contexts_to_pairs.sqlite'))
+        else:
+            pair_to_contexts = defaultdict(list)
+            contexts_to_pairs = defaultdict(list)
         unique_contexts = set()
 
-        with open(svo) as svo_contents:
-            for line in svo_contents:
-                s, v, o, n = line.split('\t')
-                n = int(n)
-                pair = tuple(sorted([s, o]))
-                rev = pair == tuple([s, o])
-                pair_to_contexts[pair].append((v, n, rev))
-                contexts_to_pairs[v].append((pair, n))
-                unique_contexts.add(v)
+        import pandas as pd
+
+        for s, v, o, n in svo_io.read_chunks(svo, self.chunk_size):
+            rev = s <= o
+            pairs = pd.MultiIndex.from_arrays([np.where(rev, s, o),
+                                               np.where(rev, o, s)])
+            extend_groups(pair_to_contexts, pairs, v, n, rev)
+            extend_groups(contexts_to_pairs, pd.Index(v), pairs.to_numpy(), n)
+            unique_contexts.update(pd.unique(v))
 
+        if isinstance(pair_to_contexts, ondisk.DiskMultimap):
+            pair_to_contexts.flush()
+            contexts_to_pairs.flush()
         ucontexts_array = np.array(sorted(unique_contexts))
 
         return {'pair_to_contexts': pair_to_contexts,
@@ -6,17 +6,42 @@ Based on "A clustering algorithm based on graph connectivity",
 
 
 import logging
-from typing import Any, List
-
-import networkx as nx
+from collections import namedtuple
+from typing import Any, List, Sequence, TYPE_CHECKING
 
 import numpy as np
 
+import progress
+
+if TYPE_CHECKING:
+    import networkx as nx
+
+
+CutTree = namedtuple('CutTree', ['parent', 'depth', 'critical', 'leaf',
+                                 'min_multiplier_threshold'])
+
 
 logger = logging.getLogger(__name__)
 
 
-def highly_connected(graph: nx.Graph,
+def ordered_subgraph(graph: 'nx.Graph', nodes) -> 'nx.Graph':
+    """Copy of the subgraph induced by the nodes, keeping the order
+    of the nodes and edges of graph (a networkx subgraph follows
+    the order of the set of nodes, which for strings changes
+    with every interpreter, and so would the cuts)
+    """
+    nodes = set(nodes)
+    subgraph = graph.__class__()
+    subgraph.add_nodes_from((node, graph.nodes[node])
+                            for node in graph if node in nodes)
+    subgraph.add_edges_from((node, neighbor, attributes)
+                            for node in subgraph
+                            for neighbor, attributes in graph[node].items()
+                            if neighbor in nodes)
+    return subgraph
+
+
+def highly_connected(graph: 'nx.Graph',
                      sum_of_removed_weights: float,
                      multiplier_threshold: float = 2
                      ) -> bool:
@@ -29,9 +54,9 @@ def highly_connected(graph: nx.Graph,
     return threshold > graph.number_of_nodes()
 
 
-def hcsw(graph: nx.Graph,
+def hcsw(graph: 'nx.Graph',
          multiplier_threshold: float = 2
-         ) -> nx.Graph:
+         ) -> 'nx.Graph':
     """Clusters a connected undirected weighted graph.
 
     Returns a graph with the same nodes but not necessarily connected
@@ -44,31 +69,37 @@ def hcsw(graph: nx.Graph,
     # singular graphs are already clustered
     if number_of_nodes < 2:
         logger.debug('Graph too small, exiting')
+        progress.tick(number_of_nodes, 'nodes')
         return graph
 
+    import networkx as nx
+
     cut_weight, partitions = nx.algorithms.connectivity.stoer_wagner(graph)
 
     if not highly_connected(graph, cut_weight, multiplier_threshold):
         logger.debug('Graph not dense, performing cut')
 
-        sub_graphs = [graph.subgraph(v).copy() for v in partitions]
+        sub_graphs = [ordered_subgraph(graph, v) for v in partitions]
 
-        component_1 = hcsw(sub_graphs[0])
-        component_2 = hcsw(sub_graphs[1])
+        component_1 = hcsw(sub_graphs[0], multiplier_threshold)
+        component_2 = hcsw(sub_graphs[1], multiplier_threshold)
 
         graph = nx.compose(component_1, component_2)
     else:
         logger.debug('Graph is dense, skipping cut')
+        progress.tick(number_of_nodes, 'nodes')
 
     return graph
 
 
-def hcsw_disconnected(graph: nx.Graph,
+def hcsw_disconnected(graph: 'nx.Graph',
                       multiplier_threshold: float = 2
-                      ) -> nx.Graph:
+                      ) -> 'nx.Graph':
+    import networkx as nx
+
     components = nx.connected_components(graph)
 
-    clustered = [hcsw(graph.subgraph(subgraph).copy(), multiplier_threshold)
+    clustered = [hcsw(ordered_subgraph(graph, subgraph), multiplier_threshold)
                  for subgraph in components]
 
     result = nx.Graph()
@@ -79,9 +110,11 @@ def hcsw_disconnected(graph: nx.Graph,
     return result
 
 
-def label(partitioned_graph: nx.Graph,
+def label(partitioned_graph: 'nx.Graph',
           node_order: List[Any]
           ) -> np.ndarray:
+    import networkx as nx
+
     order_map = {node: code for code, node in enumerate(node_order)}
 
     labels = np.zeros(len(node_order), dtype=np.int) - 1
@@ -93,3 +126,100 @@ def label(partitioned_graph: nx.Graph,
             labels[index] = cluster_code
 
     return labels
+
+
+def cut_tree(graph: 'nx.Graph',
+             min_multiplier_threshold: float
+             ) -> CutTree:
+    """Records every cut HCSw would make on the graph
+    (connected or not) for any multiplier threshold
+    of at least min_multiplier_threshold.
+
+    Each node of the tree is a subgraph, with its parent,
+    depth and critical threshold (the subgraph is highly connected
+    for thresholds above it, and -inf for single nodes);
+    leaf maps each graph node to the deepest subgraph holding it
+    """
+    import networkx as nx
+
+    parent: List[int] = []
+    depth: List[int] = []
+    critical: List[float] = []
+    leaf = {}
+
+    pending = [(ordered_subgraph(graph, component), -1, 0)
+               for component in nx.connected_components(graph)]
+    while pending:
+        subgraph, parent_index, subgraph_depth = pending.pop()
+        index = len(parent)
+        parent.append(parent_index)
+        depth.append(subgraph_depth)
+
+        number_of_nodes = subgraph.number_of_nodes()
+        if number_of_nodes < 2:
+            critical.append(-np.inf)
+        else:
+            cut_weight, partitions = \
+                nx.algorithms.connectivity.stoer_wagner(subgraph)
+            critical.append(number_of_nodes / cut_weight
+                            if cut_weight > 0 else np.inf)
+
+            if not highly_connected(subgraph, cut_weight,
+                                    min_multiplier_threshold):
+                pending.extend((ordered_subgraph(subgraph, nodes),
+                                index, subgraph_depth + 1)
+                               for nodes in partitions)
+                continue
+
+        for node in subgraph:
+            leaf[node] = index
+        progress.tick(number_of_nodes, 'nodes')
+
+    logger.debug(f'Cut tree of {graph.number_of_nodes()} nodes'
+                 f' has {len(parent)} subgraphs')
+
+    return CutTree(np.array(parent, dtype=np.int64),
+                   np.array(depth, dtype=np.int64),
+                   np.array(critical, dtype=np.float64),
+                   leaf,
+                   min_multiplier_threshold)
+
+
+def sweep_labels(tree: CutTree,
+                 multiplier_thresholds: Sequence[float],
+                 node_order: List[Any]
+                 ) -> np.ndarray:
+    """Labels of the nodes in node_order (as label would give,
+    up to the numbering of the clusters) after HCSw with each
+    of the multiplier thresholds, one row per threshold.
+
+    Read off the cut tree without computing any other cut:
+    a node belongs to its topmost highly connected subgraph
+    """
+    if min(multiplier_thresholds) < tree.min_multiplier_threshold:
+        raise ValueError('The cut tree was built for thresholds'
+                         f' of at least {tree.min_multiplier_threshold}')
+
+    leaves = np.array([tree.leaf.get(node, -1) for node in node_order],
+                      dtype=np.int64)
+    has_parent = tree.parent >= 0
+    levels = [np.flatnonzero(tree.depth == level)
+              for level in range(tree.depth.max(initial=-1) + 1)]
+
+    labels = np.zeros((len(multiplier_thresholds), len(node_order)),
+                      dtype=np.int64) - 1
+    for row, threshold in enumerate(multiplier_thresholds):
+        dense = threshold > tree.critical
+        top = np.zeros(len(tree.parent), dtype=np.int64) - 1
+
+        for level in levels:
+            inherited = np.where(has_parent[level],
+                                 top[tree.parent[level]], -1)
+            top[level] = np.where(inherited >= 0, inherited,
+                                  np.where(dense[level], level, -1))
+
+        found = leaves >= 0
+        clusters = top[leaves[found]]
+        labels[row, found] = np.unique(clusters, return_inverse=True)[1]
+
+    return labels
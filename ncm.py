@@ -3,21 +3,36 @@
 
 import itertools
 import logging
+import os
 from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from operator import itemgetter
-from typing import Any, DefaultDict, Dict, List, Tuple
+from typing import (Any, DefaultDict, Dict, List, Sequence, TYPE_CHECKING,
+                    Tuple)
 
 import hcsw
 
-import networkx as nx
-
 import numpy as np
 
+import ondisk
+
+import progress
+
+import shared_arrays
+
+if TYPE_CHECKING:
+    import networkx as nx
+
 
 logger = logging.getLogger(__name__)
 
 
 class BuildCooccurrenceGraph:
+    """Graph of the contexts, with edges weighted by the number of
+    pairs they co-occur in; counted out of core (see
+    ondisk.CooccurrenceCounter) when the counts would exceed
+    the memory budget, or pair_to_contexts is on disk
+    """
     def __init__(self, cache=False):
         self.cache = cache
 
@@ -39,10 +54,36 @@ class BuildCooccurrenceGraph:
     def returns(self):
         return ['cograph']
 
-    def apply(self, pair_to_contexts, unique_contexts, **kwargs):
+    def apply(self, pair_to_contexts, unique_contexts, output_dir=None,
+              memory_budget=None, **kwargs):
+        # networkx is slow to import, so steps load it when applied
+        import networkx as nx
+
         cograph = nx.Graph()
         cograph.add_nodes_from(unique_contexts)
 
+        if ondisk.count_out_of_core(pair_to_contexts, memory_budget):
+            counter = ondisk.count_cooccurrences(
+                pair_to_contexts, unique_contexts,
+                os.path.join(output_dir, 'cooccurrence_runs'))
+            for rows, columns, counts in counter.merge():
+                cograph.add_weighted_edges_from(
+                    zip(unique_contexts[rows].tolist(),
+                        unique_contexts[columns].tolist(),
+                        counts.tolist()))
+        else:
+            self.add_edges(cograph, pair_to_contexts)
+
+        logger.info(f'Created cograph,'
+                    f' |V|={cograph.number_of_nodes()}'
+                    f' |E|={cograph.number_of_edges()}'
+                    f' size={cograph.size()}')
+
+        return {'cograph': cograph}
+
+    def add_edges(self, cograph, pair_to_contexts):
+        import networkx as nx
+
         for pair, contexts in pair_to_contexts.items():
             # ignore value of n
             contexts = [ctx for (ctx, _, _) in contexts]
@@ -58,19 +99,26 @@ class BuildCooccurrenceGraph:
                 else:
                     cograph.add_edge(v1, v2, weight=1)
 
-        logger.info(f'Created cograph,'
-                    f' |V|={cograph.number_of_nodes()}'
-                    f' |E|={cograph.number_of_edges()}'
-                    f' size={cograph.size()}')
-
-        return {'cograph': cograph}
-
 
 class NcmHcsw:
-    def __init__(self, cache=False):
+    """HCSw clustering of the cograph, highly connected meaning
+    a cut weight above the number of nodes over multiplier times
+    the mean edge weight.
+
+    sweep is a list of other multipliers to label the contexts with,
+    all read off a single cut tree (see hcsw.cut_tree)
+    """
+    def __init__(self,
+                 multiplier: float = 2,
+                 sweep: Sequence[float] = None,
+                 cache=False):
+        self.multiplier = multiplier
+        self.sweep = sweep
         self.cache = cache
 
     def __repr__(self):
+        if self.multiplier != 2:
+            return f'NcmHcsw_{self.multiplier}'
         return 'NcmHcsw'
 
     def __str__(self):
@@ -86,19 +134,31 @@ class NcmHcsw:
         return []
 
     def returns(self):
+        if self.sweep:
+            return ['groups', 'sweep_groups']
         return ['groups']
 
-    def apply(self, cograph: nx.Graph, unique_contexts, **kwargs):
+    def apply(self, cograph: 'nx.Graph', unique_contexts, **kwargs):
         weights = [weight
                    for (from_node, to_node, weight)
                    in cograph.edges(data='weight')]
         mean_weight = np.mean(weights)
 
-        result = hcsw.hcsw_disconnected(cograph, mean_weight * 2)
+        if not self.sweep:
+            result = hcsw.hcsw_disconnected(cograph,
+                                            mean_weight * self.multiplier)
+
+            groups = hcsw.label(result, unique_contexts)
+
+            return {'groups': groups}
 
-        groups = hcsw.label(result, unique_contexts)
+        multipliers = [self.multiplier] + list(self.sweep)
+        thresholds = [mean_weight * multiplier for multiplier in multipliers]
+        tree = hcsw.cut_tree(cograph, min(thresholds))
+        labels = hcsw.sweep_labels(tree, thresholds, unique_contexts)
 
-        return {'groups': groups}
+        return {'groups': labels[0],
+                'sweep_groups': dict(zip(multipliers[1:], labels[1:]))}
 
 
 class Medoids:
@@ -124,6 +184,8 @@ class Medoids:
         return ['relation_names']
 
     def apply(self, cograph, groups, unique_contexts, **kwargs):
+        import networkx as nx
+
         node_centrality = nx.degree_centrality(cograph)
 
         centrality_array = np.zeros_like(unique_contexts, dtype=np.float)
@@ -285,14 +347,35 @@ class Pruner:
                 'groups': groups_new}
 
 
+def spanner(graph: 'nx.Graph', stretch: float,
+            seed: int = None) -> 'nx.Graph':
+    """networkx spanner of the weighted graph; reproducible for a seed,
+    as it runs on integer nodes (networkx iterates over sets of nodes,
+    whose order for strings changes with every interpreter)
+    """
+    import networkx as nx
+
+    if seed is None:
+        return nx.algorithms.spanner(graph, stretch, 'weight')
+
+    nodes = list(graph)
+    numbered = nx.convert_node_labels_to_integers(graph)
+    spanned = nx.algorithms.spanner(numbered, stretch, 'weight', seed=seed)
+    return nx.relabel_nodes(spanned, dict(enumerate(nodes)))
+
+
 class Spanner:
     def __init__(self,
                  stretch: float = 5,
+                 seed: int = None,
                  cache=False):
         self.stretch = stretch
+        self.seed = seed
         self.cache = cache
 
     def __repr__(self):
+        if self.seed is not None:
+            return f'Spanner_{self.stretch}_seed_{self.seed}'
         return f'Spanner_{self.stretch}'
 
     def __str__(self):
@@ -311,12 +394,259 @@ class Spanner:
         return ['cograph']
 
     def apply(self,
-              cograph: nx.Graph,
+              cograph: 'nx.Graph',
               **kwargs
               ) -> Dict[str, Any]:
-        spanned = nx.algorithms.spanner(cograph, self.stretch, 'weight')
+        spanned = spanner(cograph, self.stretch, self.seed)
 
         logger.debug(f'Spanning from {cograph.number_of_edges()}'
                      f' to {spanned.number_of_edges()} edges')
 
         return {'cograph': spanned}
+
+
+class ShardedNcm:
+    """Spanner, NcmHcsw and Medoids in a single step,
+    sharding the cograph by connected component.
+
+    The cograph is published to shared memory as arrays
+    (see component_arrays), from which the workers of a process
+    pool rebuild the components of their shards, batched by size.
+    Each shard is spanned once to take the HCSw threshold from
+    the mean weight of all spanned edges, then spanned again
+    and clustered; group ids are numbered component after component.
+
+    Each component is spanned with its own seed drawn from seed
+    (or from fresh entropy, so both spans of a run agree),
+    so results do not depend on the number of workers
+    """
+    def __init__(self,
+                 stretch: float = 5,
+                 multiplier: float = 2,
+                 workers: int = None,
+                 shards_per_worker: int = 4,
+                 seed: int = None,
+                 cache=False):
+        self.stretch = stretch
+        self.multiplier = multiplier
+        self.workers = workers
+        self.shards_per_worker = shards_per_worker
+        self.seed = seed
+        self.cache = cache
+
+    def __repr__(self):
+        if self.seed is not None:
+            return (f'Sharded_ncm_{self.stretch}_{self.multiplier}'
+                    f'_seed_{self.seed}')
+        return f'Sharded_ncm_{self.stretch}_{self.multiplier}'
+
+    def __str__(self):
+        return repr(self)
+
+    def required_files(self):
+        return []
+
+    def required_data(self):
+        return ['cograph', 'unique_contexts']
+
+    def creates(self):
+        return []
+
+    def returns(self):
+        return ['groups', 'relation_names']
+
+    def apply(self,
+              cograph: 'nx.Graph',
+              unique_contexts: 'np.ndarray[str]',
+              **kwargs
+              ) -> Dict[str, Any]:
+        arrays = component_arrays(cograph, unique_contexts)
+        sizes = np.diff(arrays['node_bounds']).tolist()
+        seeds = (np.random.SeedSequence(self.seed)
+                   .generate_state(len(sizes)).tolist())
+
+        workers = self.workers or os.cpu_count()
+        shards = shard_components(sizes, workers * self.shards_per_worker)
+        shard_seeds = [[seeds[i] for i in shard] for shard in shards]
+        logger.debug(f'Sharded {len(sizes)} components'
+                     f' into {len(shards)} shards')
+
+        with shared_arrays.SharedArrayRegistry() as shared:
+            for name, array in arrays.items():
+                shared.publish(name, array)
+
+            with ProcessPoolExecutor(workers) as pool:
+                weights = list(pool.map(span_weights,
+                                        itertools.repeat(shared.handles),
+                                        shards,
+                                        itertools.repeat(self.stretch),
+                                        shard_seeds))
+                weights = np.concatenate([np.empty(0)] + weights)
+                threshold = np.mean(weights) * self.multiplier
+
+                clustered = pool.map(cluster_shard,
+                                     itertools.repeat(shared.handles),
+                                     shards,
+                                     itertools.repeat(self.stretch),
+                                     shard_seeds,
+                                     itertools.repeat(threshold))
+
+                # numbered in component order, whatever the sharding
+                component_clusters = [None] * len(sizes)
+                for shard, (shard_clusters, nodes) in zip(shards, clustered):
+                    for index, clusters in zip(shard, shard_clusters):
+                        component_clusters[index] = clusters
+                    # the workers have no reporter, so HCSw is counted here
+                    progress.tick(nodes, 'nodes')
+
+        groups = np.zeros(len(unique_contexts), dtype=np.int64) - 1
+        relation_names = []
+        for clusters in component_clusters:
+            for members, medoid in clusters:
+                groups[members] = len(relation_names)
+                relation_names.append(unique_contexts[medoid])
+
+        return {'groups': groups,
+                'relation_names': relation_names}
+
+
+def component_arrays(cograph: 'nx.Graph',
+                     unique_contexts: 'np.ndarray[str]'
+                     ) -> Dict[str, np.ndarray]:
+    """The connected components of the cograph as arrays, nodes
+    being positions in unique_contexts: the nodes of each component
+    (in the cograph order) and its adjacency, as the sources, targets
+    and weights of its edges in both directions (in the order of
+    hcsw.ordered_subgraph), component i spanning node_bounds[i]
+    to node_bounds[i + 1] and edge_bounds[i] to edge_bounds[i + 1]
+    """
+    import networkx as nx
+
+    position = {context: i for i, context in enumerate(unique_contexts)}
+    component_of = {}
+    components = 0
+    for nodes in nx.connected_components(cograph):
+        for node in nodes:
+            component_of[node] = components
+        components += 1
+
+    nodes = [[] for _ in range(components)]
+    edges = [[] for _ in range(components)]
+    for node, neighbors in cograph.adjacency():
+        index = component_of[node]
+        nodes[index].append(position[node])
+        edges[index].extend((position[node], position[neighbor],
+                             attributes['weight'])
+                            for neighbor, attributes in neighbors.items())
+
+    edge_rows = [edge for component in edges for edge in component]
+    sources, targets, weights = (zip(*edge_rows) if edge_rows
+                                 else ((), (), ()))
+    return {'nodes': np.array([node for component in nodes
+                               for node in component], dtype=np.int64),
+            'node_bounds': np.cumsum([0] + [len(component)
+                                            for component in nodes]),
+            'sources': np.array(sources, dtype=np.int64),
+            'targets': np.array(targets, dtype=np.int64),
+            'weights': np.array(weights),
+            'edge_bounds': np.cumsum([0] + [len(component)
+                                            for component in edges])}
+
+
+def component_graphs(arrays: Dict[str, np.ndarray],
+                     shard: List[int]
+                     ) -> List['nx.Graph']:
+    """The components of the shard, rebuilt from their
+    component_arrays as graphs of positions
+    """
+    import networkx as nx
+
+    graphs = []
+    for index in shard:
+        graph = nx.Graph()
+        start, end = arrays['node_bounds'][index:index + 2]
+        graph.add_nodes_from(arrays['nodes'][start:end].tolist())
+        start, end = arrays['edge_bounds'][index:index + 2]
+        graph.add_weighted_edges_from(
+            zip(arrays['sources'][start:end].tolist(),
+                arrays['targets'][start:end].tolist(),
+                arrays['weights'][start:end].tolist()))
+        graphs.append(graph)
+    return graphs
+
+
+def shard_components(sizes: List[int],
+                     shard_count: int
+                     ) -> List[List[int]]:
+    """Batches the components (of the given number of nodes)
+    into about shard_count shards of similar number of nodes
+    (a large component is a shard alone),
+    each shard as the indexes of its components
+    """
+    shard_size = max(1, sum(sizes) // max(1, shard_count))
+
+    shards: List[List[int]] = []
+    current: List[int] = []
+    current_size = 0
+
+    by_size = sorted(range(len(sizes)), key=sizes.__getitem__,
+                     reverse=True)
+    for index in by_size:
+        current.append(index)
+        current_size += sizes[index]
+        if current_size >= shard_size:
+            shards.append(current)
+            current = []
+            current_size = 0
+
+    if current:
+        shards.append(current)
+
+    return shards
+
+
+def span_weights(handles: Dict[str, Any],
+                 shard: List[int],
+                 stretch: float,
+                 seeds: List[int]
+                 ) -> np.ndarray:
+    """Weights of the edges of the spanned components of the shard,
+    from the component_arrays published under the handles
+    """
+    arrays = shared_arrays.attach(handles)
+    weights = []
+    for graph, seed in zip(component_graphs(arrays, shard), seeds):
+        spanned = spanner(graph, stretch, seed)
+        weights.extend(weight for (_, _, weight)
+                       in spanned.edges(data='weight'))
+    return np.array(weights)
+
+
+def cluster_shard(handles: Dict[str, Any],
+                  shard: List[int],
+                  stretch: float,
+                  seeds: List[int],
+                  multiplier_threshold: float
+                  ) -> Tuple[List[List[Tuple[List[int], int]]], int]:
+    """HCSw clusters of each spanned component of the shard,
+    each cluster as the positions of its members and of its medoid,
+    the member of highest degree (ties to the first position);
+    and the number of nodes clustered
+    """
+    import networkx as nx
+
+    arrays = shared_arrays.attach(handles)
+    shard_clusters = []
+    nodes = 0
+    for graph, seed in zip(component_graphs(arrays, shard), seeds):
+        spanned = spanner(graph, stretch, seed)
+        clusters = []
+        clustered = hcsw.hcsw(spanned, multiplier_threshold)
+        for members in nx.connected_components(clustered):
+            medoid = min(members,
+                         key=lambda node: (-spanned.degree(node), node))
+            clusters.append((list(members), medoid))
+        shard_clusters.append(clusters)
+        nodes += spanned.number_of_nodes()
+
+    return shard_clusters, nodes
@@ -0,0 +1,317 @@
+"""Disk-backed variants of the large in-memory structures,
+used when their estimated size exceeds the memory budget
+(see Experiment(memory_budget=...))
+"""
+
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from ast import literal_eval
+from itertools import groupby
+
+import numpy as np
+
+
+WRITE_BATCH = 1 << 14
+RUN_SIZE = 1 << 24
+MERGE_BLOCK = 1 << 20
+COUNT_BYTES = 100
+
+
+logger = logging.getLogger(__name__)
+
+
+def exceeds_budget(estimate, memory_budget, what):
+    """Whether a structure of estimate bytes should go to disk
+    """
+    if memory_budget is None or estimate <= memory_budget:
+        return False
+    logger.info(f'{what} needs about {estimate >> 20} MiB, over the'
+                f' memory budget of {memory_budget >> 20} MiB;'
+                f' keeping it on disk')
+    return True
+
+
+def array(path, shape, dtype=np.float64):
+    """Zeroed array memory-mapped from a new .npy file at path
+    """
+    return np.lib.format.open_memmap(path, mode='w+',
+                                     dtype=dtype, shape=shape)
+
+
+class DiskMultimap:
+    """Mapping of keys to lists of values, stored in an SQLite file,
+    a drop-in for the defaultdict(list) indexes once they are built.
+
+    Values are added with extend; keys iterate in the order they
+    were first added, and the values of a key in the order they
+    were added. Keys are stored by their repr, so they must be
+    literals (such as strings and tuples of strings); values are
+    pickled
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self._local = threading.local()
+        self._pending = []
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE keys'
+                               ' (key TEXT PRIMARY KEY)')
+            connection.execute('CREATE TABLE entries'
+                               ' (key TEXT, values_ BLOB)')
+            connection.execute('CREATE INDEX entries_key ON entries (key)')
+
+    def __repr__(self):
+        return f'DiskMultimap({self.path!r})'
+
+    def __getstate__(self):
+        self.flush()
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._local = threading.local()
+        self._pending = []
+
+    def extend(self, key, values):
+        self._pending.append((repr(key), pickle.dumps(list(values))))
+        if len(self._pending) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        """Writes the values added so far
+        """
+        if not self._pending:
+            return
+        with self._connection() as connection:
+            connection.executemany('INSERT OR IGNORE INTO keys VALUES (?)',
+                                   ((key,) for key, _ in self._pending))
+            connection.executemany('INSERT INTO entries VALUES (?, ?)',
+                                   self._pending)
+        self._pending = []
+
+    def __getitem__(self, key):
+        self.flush()
+        rows = self._connection().execute(
+            'SELECT values_ FROM entries WHERE key = ? ORDER BY rowid',
+            (repr(key),)).fetchall()
+        if not rows:
+            raise KeyError(key)
+        return [value for (values,) in rows for value in pickle.loads(values)]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        self.flush()
+        row = self._connection().execute('SELECT 1 FROM keys WHERE key = ?',
+                                         (repr(key),)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        self.flush()
+        (count,) = self._connection().execute(
+            'SELECT COUNT(*) FROM keys').fetchone()
+        return count
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        self.flush()
+        for (key,) in self._connection().execute(
+                'SELECT key FROM keys ORDER BY rowid'):
+            yield literal_eval(key)
+
+    def values(self):
+        for _, values in self.items():
+            yield values
+
+    def items(self):
+        """Streams the (key, values) pairs, holding a single key
+        in memory at a time
+        """
+        self.flush()
+        rows = self._connection().execute(
+            'SELECT keys.key, entries.values_ FROM keys'
+            ' JOIN entries ON entries.key = keys.key'
+            ' ORDER BY keys.rowid, entries.rowid')
+        for key, group in groupby(rows, key=lambda row: row[0]):
+            yield (literal_eval(key),
+                   [value for _, values in group
+                    for value in pickle.loads(values)])
+
+    def _connection(self):
+        """A connection per thread, as steps may read from any thread
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode = OFF')
+            connection.execute('PRAGMA synchronous = OFF')
+            self._local.connection = connection
+        return connection
+
+
+def count_out_of_core(pair_to_contexts, memory_budget):
+    """Whether to count the co-occurrences of the contexts with a
+    CooccurrenceCounter: always for indexes kept on disk, else when
+    the counts (COUNT_BYTES per combination of contexts of a pair)
+    are estimated to exceed the memory budget
+    """
+    if isinstance(pair_to_contexts, DiskMultimap):
+        return True
+    if memory_budget is None:
+        return False
+    combinations = sum(len(contexts) * (len(contexts) + 1) // 2
+                       for contexts in pair_to_contexts.values())
+    return exceeds_budget(combinations * COUNT_BYTES, memory_budget,
+                          'The co-occurrence counts')
+
+
+def count_cooccurrences(pair_to_contexts, unique_contexts, directory):
+    """CooccurrenceCounter of the contexts occurring with each pair,
+    contexts being identified by their index in unique_contexts
+    (which is sorted)
+    """
+    counter = CooccurrenceCounter(directory)
+    batch = []
+    lengths = []
+    combinations = 0
+    for _, contexts in pair_to_contexts.items():
+        # ignore value of n
+        batch.extend(ctx for (ctx, _, _) in contexts)
+        lengths.append(len(contexts))
+        combinations += len(contexts) * (len(contexts) + 1) // 2
+        if combinations >= counter.run_size:
+            counter.add_groups(np.searchsorted(unique_contexts, batch),
+                               lengths)
+            batch = []
+            lengths = []
+            combinations = 0
+    counter.add_groups(np.searchsorted(unique_contexts, batch), lengths)
+    return counter
+
+
+class CooccurrenceCounter:
+    """Counts the co-occurrences of context ids in bounded memory,
+    by external sorting: the (i, j) id pairs (i <= j) are buffered,
+    sorted and counted into runs of up to run_size pairs written
+    to directory, which merge combines into the total counts.
+
+    Ids must be below 2 ** 32
+    """
+    def __init__(self, directory, run_size=RUN_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.run_size = run_size
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+
+    def add(self, ids):
+        """Counts every combination with replacement of the ids,
+        which co-occur (as the contexts of a pair)
+        """
+        n = len(ids)
+        if n * (n + 1) // 2 <= self.run_size:
+            self.add_groups(ids, [n])
+            return
+
+        # too many combinations to hold at once: one id at a time
+        ids = np.asarray(ids, dtype=np.uint64)
+        for i in range(n):
+            self._append(np.full(n - i, ids[i]), ids[i:])
+
+    def add_groups(self, ids, lengths):
+        """add for each group of ids, the groups being consecutive
+        slices of ids of the given lengths
+        """
+        ids = np.asarray(ids, dtype=np.uint64)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if (lengths * (lengths + 1) // 2).sum() > self.run_size:
+            for group in np.split(ids, np.cumsum(lengths)[:-1]):
+                self.add(group)
+            return
+
+        # each id combines with itself and the ids after it in its group
+        group_ends = np.repeat(np.cumsum(lengths), lengths)
+        partners = group_ends - np.arange(len(ids))
+        first = np.repeat(np.arange(len(ids)), partners)
+        offsets = np.arange(len(first)) - np.repeat(np.cumsum(partners)
+                                                    - partners, partners)
+        self._append(ids[first], ids[first + offsets])
+
+    def merge(self, block_size=MERGE_BLOCK):
+        """Yields the counts as sorted blocks of (rows, columns, counts)
+        arrays, rows <= columns, merging block_size keys of each run
+        at a time; the runs are deleted once merged
+        """
+        self._write_run()
+        runs = [(np.load(keys_path, mmap_mode='r'),
+                 np.load(counts_path, mmap_mode='r'))
+                for keys_path, counts_path in self._runs]
+        positions = [0] * len(runs)
+
+        try:
+            while any(position < len(keys)
+                      for position, (keys, _) in zip(positions, runs)):
+                # every key up to the smallest block end is loaded
+                cutoff = min(keys[min(position + block_size, len(keys)) - 1]
+                             for position, (keys, _) in zip(positions, runs)
+                             if position < len(keys))
+
+                block_keys = []
+                block_counts = []
+                for i, (keys, counts) in enumerate(runs):
+                    start = positions[i]
+                    end = start + int(np.searchsorted(
+                        keys[start:start + block_size], cutoff,
+                        side='right'))
+                    block_keys.append(keys[start:end])
+                    block_counts.append(counts[start:end])
+                    positions[i] = end
+
+                merged, inverse = np.unique(np.concatenate(block_keys),
+                                            return_inverse=True)
+                merged_counts = np.bincount(
+                    inverse, weights=np.concatenate(block_counts),
+                    minlength=len(merged)).astype(np.int64)
+                yield ((merged >> np.uint64(32)).astype(np.int64),
+                       (merged & np.uint64(0xffffffff)).astype(np.int64),
+                       merged_counts)
+        finally:
+            for paths in self._runs:
+                for path in paths:
+                    os.remove(path)
+            self._runs = []
+
+    def _append(self, first, second):
+        low = np.minimum(first, second)
+        high = np.maximum(first, second)
+        self._buffer.append((low << np.uint64(32)) | high)
+        self._buffered += len(low)
+        if self._buffered >= self.run_size:
+            self._write_run()
+
+    def _write_run(self):
+        if not self._buffered:
+            return
+        keys, counts = np.unique(np.concatenate(self._buffer),
+                                 return_counts=True)
+        self._buffer = []
+        self._buffered = 0
+
+        run = os.path.join(self.directory, f'run_{len(self._runs)}')
+        paths = (f'{run}_keys.npy', f'{run}_counts.npy')
+        np.save(paths[0], keys)
+        np.save(paths[1], counts.astype(np.int64))
+        self._runs.append(paths)
+        logger.debug(f'Wrote co-occurrence run {run} ({len(keys)} keys)')
@@ -1,18 +1,34 @@
 import itertools
 import logging
+import os
 from collections import defaultdict
 
 import numpy as np
 
-from sklearn.cluster import KMeans
-from sklearn.metrics import pairwise_distances_argmin_min
+import ondisk
+
+from scipy import sparse
+
+
+# sklearn and joblib are imported where used, as they are slow to load
 
 
 class BuildCooccurrenceMatrix:
-    def __init__(self, cache=False):
+    def __init__(self, sparse=False, cache=False):
+        """sparse builds a scipy CSR matrix instead of a dense array;
+        a dense array over the memory budget is memory-mapped
+        from comatrix.npy in the output directory.
+
+        Co-occurrences are counted out of core (see
+        ondisk.CooccurrenceCounter) when the counts would exceed
+        the memory budget, or pair_to_contexts is on disk
+        """
+        self.sparse = sparse
         self.cache = cache
 
     def __repr__(self):
+        if self.sparse:
+            return 'Build_sparse_cooccurrence_matrix'
         return 'Build_cooccurrence_matrix'
 
     def __str__(self):
@@ -30,7 +46,35 @@ class BuildCooccurrenceMatrix:
     def returns(self):
         return ['comatrix']
 
-    def apply(self, pair_to_contexts, unique_contexts, **kwargs):
+    def apply(self, pair_to_contexts, unique_contexts, output_dir=None,
+              memory_budget=None, **kwargs):
+        n = len(unique_contexts)
+
+        if ondisk.count_out_of_core(pair_to_contexts, memory_budget):
+            counter = ondisk.count_cooccurrences(
+                pair_to_contexts, unique_contexts,
+                os.path.join(output_dir, 'cooccurrence_runs'))
+            blocks = (symmetric_coordinates(*block)
+                      for block in counter.merge())
+        else:
+            blocks = [self.coordinates(self.count(pair_to_contexts),
+                                       unique_contexts)]
+
+        if self.sparse:
+            return {'comatrix': self.to_csr(blocks, n)}
+
+        if ondisk.exceeds_budget(n * n * 8, memory_budget, 'The comatrix'):
+            matrix_array = ondisk.array(os.path.join(output_dir,
+                                                     'comatrix.npy'), (n, n))
+        else:
+            matrix_array = np.zeros((n, n))
+
+        for rows, columns, counts in blocks:
+            matrix_array[rows, columns] = counts
+
+        return {'comatrix': matrix_array}
+
+    def count(self, pair_to_contexts):
         matrix = defaultdict(lambda: 0)
 
         for pair, contexts in pair_to_contexts.items():
@@ -42,24 +86,74 @@ class BuildCooccurrenceMatrix:
                 matrix[(v1, v2)] += 1
                 matrix[(v2, v1)] += 1
 
-        n = len(unique_contexts)
-        matrix_array = np.zeros((n, n))
-
-        for i in range(n):
-            for j in range(n):
-                v1 = unique_contexts[i]
-                v2 = unique_contexts[j]
-                matrix_array[i, j] = matrix[(v1, v2)]
+        return matrix
 
-        return {'comatrix': matrix_array}
+    def coordinates(self, matrix, unique_contexts):
+        """Row, column and count arrays of the counted context pairs
+        """
+        context_index = {context: i
+                         for i, context in enumerate(unique_contexts)}
+
+        rows = np.fromiter((context_index[v1] for v1, _ in matrix.keys()),
+                           dtype=np.int64, count=len(matrix))
+        columns = np.fromiter((context_index[v2] for _, v2 in matrix.keys()),
+                              dtype=np.int64, count=len(matrix))
+        counts = np.fromiter(matrix.values(),
+                             dtype=np.float64, count=len(matrix))
+
+        return rows, columns, counts
+
+    def to_csr(self, blocks, n):
+        rows = [np.empty(0, dtype=np.int64)]
+        columns = [np.empty(0, dtype=np.int64)]
+        counts = [np.empty(0)]
+        for block_rows, block_columns, block_counts in blocks:
+            rows.append(block_rows)
+            columns.append(block_columns)
+            counts.append(block_counts)
+
+        return sparse.csr_matrix((np.concatenate(counts),
+                                  (np.concatenate(rows),
+                                   np.concatenate(columns))),
+                                 shape=(n, n))
+
+
+def symmetric_coordinates(rows, columns, counts):
+    """Coordinates of the co-occurrence matrix from the counts
+    of the unordered context pairs (rows <= columns): each
+    co-occurrence counts in both directions, so twice on the diagonal
+    """
+    off_diagonal = rows != columns
+    return (np.concatenate([rows, columns[off_diagonal]]),
+            np.concatenate([columns, rows[off_diagonal]]),
+            np.concatenate([np.where(off_diagonal, counts, 2 * counts),
+                            counts[off_diagonal]]).astype(np.float64))
 
 
 class NormalizeMatrix:
-    def __init__(self, cache=False):
+    WEIGHTINGS = ('row', 'ppmi', 'tfidf')
+
+    def __init__(self, weighting='row', in_place=True, cache=False):
+        """weighting is one of:
+        'row' divides each row by its sum;
+        'ppmi' is the positive pointwise mutual information of the counts;
+        'tfidf' weights the row frequencies by the inverse number
+        of rows each column occurs in.
+
+        Rows of zeros are kept as zeros. Dense float input
+        is normalized in place unless in_place is False,
+        as is the data of sparse CSR input
+        """
+        if weighting not in self.WEIGHTINGS:
+            raise ValueError(f'Unknown weighting {weighting}')
+        self.weighting = weighting
+        self.in_place = in_place
         self.cache = cache
 
     def __repr__(self):
-        return 'Normalize_matrix'
+        if self.weighting == 'row':
+            return 'Normalize_matrix'
+        return f'Normalize_matrix_{self.weighting}'
 
     def __str__(self):
         return repr(self)
@@ -77,18 +171,168 @@ class NormalizeMatrix:
         return ['comatrix']
 
     def apply(self, comatrix, **kwargs):
-        row_means = comatrix.sum(axis=1).reshape(-1, 1)
-        normalized = comatrix / row_means
+        if sparse.issparse(comatrix):
+            normalized = comatrix.tocsr()
+            if not self.in_place or normalized.dtype.kind != 'f':
+                normalized = normalized.astype(np.float64)
+            values = normalized.data
+            rows = np.repeat(np.arange(normalized.shape[0]),
+                             np.diff(normalized.indptr))
+            columns = normalized.indices
+        else:
+            normalized = np.asarray(comatrix)
+            if not self.in_place or normalized.dtype.kind != 'f':
+                normalized = normalized.astype(np.float64)
+            values = normalized
+            rows = np.arange(normalized.shape[0]).reshape(-1, 1)
+            columns = np.arange(normalized.shape[1]).reshape(1, -1)
+
+        row_sums = np.asarray(normalized.sum(axis=1)).ravel()
+        empty_rows = row_sums == 0
+        if empty_rows.any():
+            logging.debug(f'comatrix has {empty_rows.sum()} empty rows')
+        # empty rows have no values to divide, avoids 0 / 0
+        row_sums[empty_rows] = 1
+
+        if self.weighting == 'row':
+            values /= row_sums[rows]
+
+        elif self.weighting == 'ppmi':
+            column_sums = np.asarray(normalized.sum(axis=0)).ravel()
+            column_sums[column_sums == 0] = 1
+            total = row_sums[~empty_rows].sum()
+
+            values *= total
+            values /= row_sums[rows]
+            values /= column_sums[columns]
+            np.log(values, out=values, where=values > 0)
+            np.maximum(values, 0, out=values)
+
+        elif self.weighting == 'tfidf':
+            if sparse.issparse(normalized):
+                document_frequency = np.bincount(columns,
+                                                 minlength=normalized.shape[1])
+            else:
+                document_frequency = np.count_nonzero(normalized, axis=0)
+            idf = np.zeros(normalized.shape[1])
+            occurring = document_frequency > 0
+            idf[occurring] = np.log(normalized.shape[0]
+                                    / document_frequency[occurring])
+
+            values /= row_sums[rows]
+            values *= idf[columns]
+
+        if sparse.issparse(normalized):
+            normalized.eliminate_zeros()
+
         return {'comatrix': normalized}
 
 
+class ReduceDimensions:
+    """Projects the comatrix onto n_components dimensions,
+    by truncated SVD ('svd') or sparse random projection
+    ('random_projection'); works on dense and sparse input.
+
+    The reduced comatrix replaces the original one,
+    so clustering, medoids and ranking all use it
+    """
+    def __init__(self, n_components=100, method='svd',
+                 seed=None, cache=False):
+        if n_components <= 0:
+            raise ValueError('n_components must be positive')
+        if method not in ('svd', 'random_projection'):
+            raise ValueError(f'Unknown method {method}')
+        self.n_components = n_components
+        self.method = method
+        self.seed = seed
+        self.cache = cache
+
+    def __repr__(self):
+        if self.seed is not None:
+            return (f'Reduce_dimensions_{self.method}_{self.n_components}'
+                    f'_seed_{self.seed}')
+        return f'Reduce_dimensions_{self.method}_{self.n_components}'
+
+    def __str__(self):
+        return repr(self)
+
+    def required_files(self):
+        return []
+
+    def required_data(self):
+        return ['comatrix']
+
+    def creates(self):
+        return []
+
+    def returns(self):
+        return ['comatrix', 'reducer']
+
+    def apply(self, comatrix, **kwargs):
+        n_features = comatrix.shape[1]
+
+        # truncated SVD needs fewer components than features
+        if self.n_components >= n_features:
+            logging.info(f'comatrix has only {n_features} dimensions,'
+                         f' not reducing')
+            return {'comatrix': comatrix, 'reducer': None}
+
+        if self.method == 'svd':
+            from sklearn.decomposition import TruncatedSVD
+            reducer = TruncatedSVD(n_components=self.n_components,
+                                   random_state=self.seed)
+        else:
+            from sklearn.random_projection import SparseRandomProjection
+            reducer = SparseRandomProjection(n_components=self.n_components,
+                                             dense_output=True,
+                                             random_state=self.seed)
+
+        reduced = reducer.fit_transform(comatrix)
+
+        logging.debug(f'Reduced comatrix from {comatrix.shape}'
+                      f' to {reduced.shape}')
+
+        return {'comatrix': reduced, 'reducer': reducer}
+
+
 class OntextKmeans:
-    def __init__(self, k=5, cache=False):
+    def __init__(self, k=5, mini_batch=False, batch_size=1024,
+                 seed=None, k_candidates=range(2, 11),
+                 criterion='silhouette', silhouette_sample=1000,
+                 n_jobs=-1, cache=False):
+        """mini_batch clusters with MiniBatchKMeans, in batches
+        of batch_size contexts, and takes the medoid of each cluster
+        only among its members; it suits large (sparse) comatrix
+
+        k='auto' fits every k in k_candidates (in parallel, over n_jobs
+        chains of increasing k, each fit warm-started from the previous
+        centroids) and keeps the best by criterion: 'silhouette'
+        (over a sample of silhouette_sample contexts) or 'elbow'
+        (of the inertia)
+        """
+        if k != 'auto' and k <= 0:
+            raise ValueError('k must be positive or auto')
+        if criterion not in ('silhouette', 'elbow'):
+            raise ValueError(f'Unknown criterion {criterion}')
         self.k = k
+        self.mini_batch = mini_batch
+        self.batch_size = batch_size
+        self.seed = seed
+        self.k_candidates = sorted(k_candidates)
+        self.criterion = criterion
+        self.silhouette_sample = silhouette_sample
+        self.n_jobs = n_jobs
         self.cache = cache
 
     def __repr__(self):
-        return f'Ontext_kmeans_{self.k}'
+        k = self.k
+        if k == 'auto':
+            k = (f'auto_{self.criterion}'
+                 f'_{self.k_candidates[0]}-{self.k_candidates[-1]}')
+        seed = '' if self.seed is None else f'_seed_{self.seed}'
+        if self.mini_batch:
+            return f'Ontext_minibatch_kmeans_{k}_{self.batch_size}{seed}'
+        return f'Ontext_kmeans_{k}{seed}'
 
     def __str__(self):
         return repr(self)
@@ -103,35 +347,187 @@ class OntextKmeans:
         return []
 
     def returns(self):
-        return ['cluster_data', 'groups', 'centroids', 'medoids',
-                'relation_names', 'relation_count']
+        returns = ['cluster_data', 'groups', 'centroids', 'medoids',
+                   'relation_names', 'relation_count']
+        if self.k == 'auto':
+            returns.append('k_scores')
+        return returns
 
     def apply(self, comatrix, unique_contexts, **kwargs):
-        if comatrix.size == 0:
+        if comatrix.shape[0] == 0:
             logging.info('comatrix is shaped (0, 0)')
 
-            return {'cluster_data': None,
-                    'groups': [],
-                    'centroids': [],
-                    'medoids': [],
-                    'relation_names': [],
-                    'relation_count': 0}
-
-        clusterer = KMeans(n_clusters=self.k, init='k-means++')
-
-        clusterer.fit(comatrix)
+            result = {'cluster_data': None,
+                      'groups': [],
+                      'centroids': [],
+                      'medoids': [],
+                      'relation_names': [],
+                      'relation_count': 0}
+            if self.k == 'auto':
+                result['k_scores'] = {}
+            return result
+
+        if self.k == 'auto':
+            clusterer, k_scores = self.select_k(comatrix)
+        else:
+            clusterer = self.clusterer(self.k)
+            clusterer.fit(comatrix)
 
         groups = clusterer.predict(comatrix)
         centroids = clusterer.cluster_centers_
-        medoids, _ = pairwise_distances_argmin_min(centroids, comatrix)
+        if self.mini_batch:
+            medoids = cluster_medoids(comatrix, groups, centroids)
+        else:
+            from sklearn.metrics import pairwise_distances_argmin_min
+            medoids, _ = pairwise_distances_argmin_min(centroids, comatrix)
         relation_names = unique_contexts[medoids]
 
-        return {'cluster_data': clusterer,
-                'groups': groups,
-                'centroids': centroids,
-                'medoids': medoids,
-                'relation_names': relation_names,
-                'relation_count': len(relation_names)}
+        result = {'cluster_data': clusterer,
+                  'groups': groups,
+                  'centroids': centroids,
+                  'medoids': medoids,
+                  'relation_names': relation_names,
+                  'relation_count': len(relation_names)}
+        if self.k == 'auto':
+            result['k_scores'] = k_scores
+        return result
+
+    def clusterer(self, k, init='k-means++'):
+        from sklearn.cluster import KMeans, MiniBatchKMeans
+
+        if self.mini_batch:
+            return MiniBatchKMeans(n_clusters=k,
+                                   init=init,
+                                   batch_size=self.batch_size,
+                                   n_init=3 if isinstance(init, str) else 1,
+                                   random_state=self.seed)
+        if isinstance(init, str):
+            return KMeans(n_clusters=k, init=init, random_state=self.seed)
+        return KMeans(n_clusters=k, init=init, n_init=1,
+                      random_state=self.seed)
+
+    def select_k(self, comatrix):
+        """Fits every candidate k, returns the best clustering
+        and the score of each candidate
+        """
+        from joblib import Parallel, delayed, effective_n_jobs
+
+        n = comatrix.shape[0]
+        candidates = [k for k in self.k_candidates if k < n] or [n]
+
+        chains = min(effective_n_jobs(self.n_jobs), len(candidates))
+        fitted = Parallel(n_jobs=chains)(
+            delayed(self.fit_chain)(comatrix, list(ks))
+            for ks in np.array_split(candidates, chains))
+        clusterers = {clusterer.n_clusters: clusterer
+                      for chain in fitted for clusterer in chain}
+
+        if self.criterion == 'silhouette':
+            k_scores = {k: self.silhouette(comatrix, clusterer)
+                        for k, clusterer in clusterers.items()}
+            chosen_k = max(k_scores, key=k_scores.get)
+        else:
+            k_scores = {k: clusterer.inertia_
+                        for k, clusterer in clusterers.items()}
+            chosen_k = elbow(k_scores)
+
+        logging.info(f'Chosen k={chosen_k} by {self.criterion}')
+
+        return clusterers[chosen_k], k_scores
+
+    def fit_chain(self, comatrix, ks):
+        """Fits the ks in increasing order, each one starting from
+        the previous centroids plus the rows farthest from them
+        """
+        fitted = []
+        init = 'k-means++'
+
+        for k in ks:
+            if fitted:
+                init = farthest_rows_init(comatrix,
+                                          fitted[-1].cluster_centers_, k)
+            clusterer = self.clusterer(int(k), init)
+            clusterer.fit(comatrix)
+            fitted.append(clusterer)
+
+        return fitted
+
+    def silhouette(self, comatrix, clusterer):
+        from sklearn.metrics import silhouette_score
+
+        labels = clusterer.labels_
+        if len(np.unique(labels)) < 2:
+            return -1.0
+        return silhouette_score(comatrix, labels,
+                                sample_size=min(self.silhouette_sample,
+                                                comatrix.shape[0]),
+                                random_state=self.seed)
+
+
+def farthest_rows_init(matrix, centroids, k):
+    """Extends the centroids up to k by repeatedly adding
+    the row farthest from its closest centroid
+    """
+    from sklearn.metrics import pairwise_distances_argmin_min
+
+    centroids = np.asarray(centroids)
+
+    while len(centroids) < k:
+        _, distances = pairwise_distances_argmin_min(matrix, centroids)
+        farthest = dense_row(matrix, distances.argmax())
+        centroids = np.vstack([centroids, farthest])
+
+    return centroids
+
+
+def elbow(inertias):
+    """The k of the elbow of the inertia curve, the point
+    farthest from the line between its first and last points
+    """
+    ks = np.array(sorted(inertias))
+    if len(ks) < 3:
+        return int(ks[0])
+
+    values = np.array([inertias[k] for k in ks], dtype=np.float64)
+
+    # normalizes both axes to 0-1, the line is then y = 1 - x
+    x = (ks - ks[0]) / (ks[-1] - ks[0])
+    value_range = values[0] - values[-1]
+    if value_range <= 0:
+        return int(ks[0])
+    y = (values - values[-1]) / value_range
+
+    return int(ks[np.argmax(1 - x - y)])
+
+
+def cluster_medoids(matrix, groups, centroids):
+    """Index of the row of each cluster closest to its centroid,
+    searching only the rows in the cluster
+    (or all rows, for an empty cluster)
+    """
+    from sklearn.metrics import pairwise_distances_argmin_min
+
+    medoids = np.zeros(len(centroids), dtype=np.int64)
+
+    for group_id, centroid in enumerate(centroids):
+        members = np.where(groups == group_id)[0]
+        if len(members) == 0:
+            members = np.arange(matrix.shape[0])
+
+        closest, _ = pairwise_distances_argmin_min(centroid.reshape(1, -1),
+                                                   matrix[members])
+        medoids[group_id] = members[closest[0]]
+
+    return medoids
+
+
+def dense_row(matrix, index):
+    """The row of a dense or sparse matrix, as a 1-d array
+    """
+    row = matrix[index]
+    if sparse.issparse(row):
+        return row.toarray().ravel()
+    return np.asarray(row).ravel()
 
 
 class InstanceRanker:
@@ -168,7 +564,8 @@ class InstanceRanker:
 
             for context, occurrences in contexts_to_pairs.items():
                 if context in cluster_contexts:
-                    c_value = comatrix[np.where(unique_contexts == context)][0]
+                    context_index = np.where(unique_contexts == context)[0][0]
+                    c_value = dense_row(comatrix, context_index)
                     sd = np.std(c_value - centroid)
                     for pair, n in occurrences:
                         scores[-1][pair] += n / (1 + sd)
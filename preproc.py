@@ -2,19 +2,62 @@
 """
 
 
+import hashlib
 import logging
 import os
 from collections import defaultdict
 
+import counters
+
+import numpy as np
+
+import progress
+
+import svo_io
+
+
+PROGRESS_LINES = 1 << 16
+
 
 logger = logging.getLogger(__name__)
 
 
+def kept_chunks(svo, keep, chunk_size=svo_io.LINES_PER_CHUNK):
+    """The chunks of the SVO (see svo_io.read_chunks) with the
+    boolean array of which of their lines to keep, keep mapping
+    the columns of a chunk to it (see svo_io.write_filtered)
+    """
+    for columns in svo_io.read_chunks(svo, chunk_size):
+        yield columns, keep(*columns)
+
+
+def counted_kept_chunks(svo, keys, minimum, counter,
+                        chunk_size=svo_io.LINES_PER_CHUNK):
+    """kept_chunks keeping the lines of the SVO with a key appearing
+    in at least minimum lines, counted with the counter
+    (see counters) in a first pass.
+
+    keys maps the columns of a chunk of the SVO to their keys
+    """
+    for columns in svo_io.read_chunks(svo, chunk_size):
+        counter.add(keys(*columns))
+
+    return kept_chunks(svo,
+                       lambda *columns: (counter.counts_of(keys(*columns))
+                                         >= minimum),
+                       chunk_size)
+
+
 class FilterSentencesByOccurrence:
-    def __init__(self, min_occurrences, cache=True):
+    def __init__(self, min_occurrences, compression=None,
+                 selection_threshold=svo_io.SELECTION_THRESHOLD,
+                 chunk_size=svo_io.LINES_PER_CHUNK, cache=True):
         if min_occurrences <= 0:
             raise ValueError('min_occurrences must be positive')
         self.min_occurrences = min_occurrences
+        self.compression = compression
+        self.selection_threshold = selection_threshold
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
@@ -36,25 +79,26 @@ class FilterSentencesByOccurrence:
         return []
 
     def apply(self, output_dir, svo, **kwargs):
-        new_svo_path = os.path.join(output_dir, 'svo')
-
-        with open(svo, 'r') as old_svo:
-            with open(new_svo_path, 'w') as new_svo:
-                self._filter(old_svo, new_svo)
+        svo_io.write_filtered(svo, os.path.join(output_dir, 'svo'),
+                              kept_chunks(svo, self._keep, self.chunk_size),
+                              compression=self.compression,
+                              threshold=self.selection_threshold)
 
-    def _filter(self, instream, outstream):
-        for line in instream:
-            s, v, o, n = line.split('\t')
-            if int(n) >= self.min_occurrences:
-                outstream.write(line)
+    def _keep(self, s, v, o, n):
+        return n >= self.min_occurrences
 
 
 class FilterInstanceInCategory:
     """Filters the SVO to only sentences
     within the two categories
     """
-    def __init__(self, reverse=True, cache=True):
+    def __init__(self, reverse=True, compression=None,
+                 selection_threshold=svo_io.SELECTION_THRESHOLD,
+                 chunk_size=svo_io.LINES_PER_CHUNK, cache=True):
         self.reverse = reverse
+        self.compression = compression
+        self.selection_threshold = selection_threshold
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
@@ -78,16 +122,107 @@ class FilterInstanceInCategory:
         return []
 
     def apply(self, output_dir, svo, cat1, cat2, **kwargs):
-        new_svo_path = os.path.join(output_dir, 'svo')
-        with open(new_svo_path, 'w') as outstream:
-            with open(svo, 'r') as svo_contents:
-                for line in svo_contents:
-                    s, v, o, n = line.split('\t')
-                    lefttoright = s in cat1 and o in cat2
-                    righttoleft = self.reverse and o in cat1 and s in cat2
+        def keep(s, v, o, n):
+            lefttoright = svo_io.isin(s, cat1) & svo_io.isin(o, cat2)
+            if not self.reverse:
+                return lefttoright
+            righttoleft = svo_io.isin(o, cat1) & svo_io.isin(s, cat2)
+            return lefttoright | righttoleft
+
+        svo_io.write_filtered(svo, os.path.join(output_dir, 'svo'),
+                              kept_chunks(svo, keep, self.chunk_size),
+                              compression=self.compression,
+                              threshold=self.selection_threshold)
+
+
+def routed_svo_name(cat1, cat2):
+    """Name of the SVO file of a category pair
+    created by RouteInstancesToPairs
+    """
+    return f'svo.{cat1}.{cat2}'
+
+
+class RouteInstancesToPairs:
+    """Filters the SVO for many category pairs in a single scan,
+    writing the sentences of each pair (as FilterInstanceInCategory
+    would) to its own file, named by routed_svo_name.
+    Repeated pairs are routed once.
 
-                    if lefttoright or righttoleft:
-                        outstream.write(line)
+    Categories are taken from a category_store.CategoryStore
+    """
+    def __init__(self, category_pairs, store, reverse=True, compression=None,
+                 cache=True):
+        self.category_pairs = list(dict.fromkeys(tuple(pair)
+                                                 for pair in category_pairs))
+        self.store = store
+        self.reverse = reverse
+        self.compression = compression
+        self.cache = cache
+
+    def __repr__(self):
+        pairs = '\n'.join(sorted(' '.join(pair)
+                                 for pair in self.category_pairs))
+        digest = hashlib.md5(pairs.encode()).hexdigest()[:10]
+        if not self.reverse:
+            return f'Route_instance_in_category_{digest}_oneway'
+        return f'Route_instance_in_category_{digest}'
+
+    def __str__(self):
+        return repr(self)
+
+    def required_files(self):
+        return ['svo']
+
+    def required_data(self):
+        return []
+
+    def creates(self):
+        return [routed_svo_name(cat1, cat2)
+                for cat1, cat2 in self.category_pairs]
+
+    def returns(self):
+        return []
+
+    def apply(self, output_dir, svo, **kwargs):
+        instance_categories = defaultdict(set)
+        for category in {c for pair in self.category_pairs for c in pair}:
+            for instance in self.store.names(category):
+                instance_categories[instance].add(category)
+
+        # maps (category of S, category of O) to the matching pairs
+        routes = defaultdict(list)
+        for pair_index, (cat1, cat2) in enumerate(self.category_pairs):
+            routes[cat1, cat2].append(pair_index)
+            if self.reverse and cat1 != cat2:
+                routes[cat2, cat1].append(pair_index)
+
+        outstreams = [svo_io.open_svo(os.path.join(output_dir, filename),
+                                      'w', compression=self.compression)
+                      for filename in self.creates()]
+        try:
+            with svo_io.open_svo(svo) as svo_contents:
+                for line_number, line in enumerate(svo_contents, 1):
+                    if line_number % PROGRESS_LINES == 0:
+                        progress.tick(PROGRESS_LINES, 'lines')
+                    s, v, o, n = line.split('\t')
+                    s_categories = instance_categories.get(s)
+                    if not s_categories:
+                        continue
+                    o_categories = instance_categories.get(o)
+                    if not o_categories:
+                        continue
+
+                    matched = set()
+                    for s_category in s_categories:
+                        for o_category in o_categories:
+                            matched.update(routes.get((s_category,
+                                                       o_category), ()))
+
+                    for pair_index in matched:
+                        outstreams[pair_index].write(line)
+        finally:
+            for outstream in outstreams:
+                outstream.close()
 
 
 class MinimumContextOccurrence:
@@ -95,15 +230,31 @@ class MinimumContextOccurrence:
     that happens in a minimum number of
     different sentences.
 
-    Makes two passes in the SVO
+    Makes two passes in the SVO. Counting is 'exact' (pandas counts
+    of the contexts), 'hashed' (exact up to 64-bit hash collisions, in NumPy
+    arrays) or 'sketch' (a count-min sketch of fixed size,
+    which may keep a few contexts below the minimum)
     """
-    def __init__(self, minimum_sentences, cache=True):
+    def __init__(self, minimum_sentences, compression=None,
+                 selection_threshold=svo_io.SELECTION_THRESHOLD,
+                 counting='exact', sketch_width=None,
+                 chunk_size=svo_io.LINES_PER_CHUNK, cache=True):
         if minimum_sentences <= 0:
             raise ValueError('minimum_sentences must be positive')
+        if counting not in counters.COUNTING_MODES:
+            raise ValueError(f'Unknown counting mode {counting}')
         self.minimum_sentences = minimum_sentences
+        self.counting = counting
+        self.sketch_width = sketch_width
+        self.compression = compression
+        self.selection_threshold = selection_threshold
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
+        if self.counting == 'sketch':
+            return (f'Minimum_context_occurrence_{self.minimum_sentences}'
+                    '_sketch')
         return f'Minimum_context_occurrence_{self.minimum_sentences}'
 
     def __str__(self):
@@ -122,47 +273,59 @@ class MinimumContextOccurrence:
         return []
 
     def apply(self, output_dir, svo, **kwargs):
-        with open(svo, 'r') as svo_file:
-            occ = self.count(svo_file)
-
-        new_svo_path = os.path.join(output_dir, 'svo')
-
-        input_size = 0
-        output_size = 0
-
-        with open(new_svo_path, 'w') as outstream:
-            with open(svo, 'r') as instream:
-                for line in instream:
-                    s, v, o, n = line.split('\t')
-                    input_size += 1
-                    if occ[v] >= self.minimum_sentences:
-                        outstream.write(line)
-                        output_size += 1
+        if self.counting == 'exact':
+            keys = self._contexts
+        else:
+            keys = self._context_hashes
+        chunks = counted_kept_chunks(svo, keys, self.minimum_sentences,
+                                     counters.counter(self.counting,
+                                                      self.sketch_width),
+                                     self.chunk_size)
+
+        keep = svo_io.write_filtered(svo, os.path.join(output_dir, 'svo'),
+                                     chunks,
+                                     compression=self.compression,
+                                     threshold=self.selection_threshold)
+        input_size = len(keep)
+        output_size = int(keep.sum())
 
         logger.debug(f'Applied self=<{repr(self)}>'
                      f' filtering input_size=<{input_size}> lines'
                      f' to output_size=<{output_size}> lines')
 
-    def count(self, svo_file):
-        occurrences = defaultdict(lambda: 0)
-        for line in svo_file:
-            s, v, o, n = line.split('\t')
-            occurrences[v] += 1
+    def _contexts(self, s, v, o, n):
+        return v
 
-        return occurrences
+    def _context_hashes(self, s, v, o, n):
+        return counters.hash_strings(v)
 
 
 class MinimumPairOccurrence:
     """Filter sentences with (S, O) pairs
-    that do not appear in a minimum of different sentences
+    that do not appear in a minimum of different sentences.
+
+    Counting is 'exact', 'hashed' or 'sketch',
+    as in MinimumContextOccurrence
     """
-    def __init__(self, minimum, cache=True):
+    def __init__(self, minimum, compression=None,
+                 selection_threshold=svo_io.SELECTION_THRESHOLD,
+                 counting='exact', sketch_width=None,
+                 chunk_size=svo_io.LINES_PER_CHUNK, cache=True):
         if minimum <= 1:
             raise ValueError('minimum must be at least 2')
+        if counting not in counters.COUNTING_MODES:
+            raise ValueError(f'Unknown counting mode {counting}')
         self.minimum = minimum
+        self.counting = counting
+        self.sketch_width = sketch_width
+        self.compression = compression
+        self.selection_threshold = selection_threshold
+        self.chunk_size = chunk_size
         self.cache = cache
 
     def __repr__(self):
+        if self.counting == 'sketch':
+            return f'Minimum_pair_occurrence_{self.minimum}_sketch'
         return f'Minimum_pair_occurrence_{self.minimum}'
 
     def __str__(self):
@@ -181,22 +344,25 @@ class MinimumPairOccurrence:
         return []
 
     def apply(self, output_dir, svo, **kwargs):
-        with open(svo) as svo_contents:
-            occ = self.count(svo_contents)
-
-        new_svo_path = os.path.join(output_dir, 'svo')
-        with open(new_svo_path, 'w') as outstream:
-            with open(svo, 'r') as instream:
-                for line in instream:
-                    s, v, o, n = line.split('\t')
-                    pair = frozenset([s, o])
-                    if occ[pair] >= self.minimum:
-                        outstream.write(line)
-
-    def count(self, svo):
-        occurrences = defaultdict(lambda: 0)
-        for line in svo:
-            s, v, o, n = line.split('\t')
-            pair = frozenset([s, o])
-            occurrences[pair] += 1
-        return occurrences
+        if self.counting == 'exact':
+            keys = self._pairs
+        else:
+            keys = self._pair_hashes
+        chunks = counted_kept_chunks(svo, keys, self.minimum,
+                                     counters.counter(self.counting,
+                                                      self.sketch_width),
+                                     self.chunk_size)
+
+        svo_io.write_filtered(svo, os.path.join(output_dir, 'svo'), chunks,
+                              compression=self.compression,
+                              threshold=self.selection_threshold)
+
+    def _pairs(self, s, v, o, n):
+        """The (S, O) pairs, in the same order for (a, b) and (b, a)
+        """
+        ordered = s <= o
+        return (np.where(ordered, s, o) + '\t'
+                + np.where(ordered, o, s))
+
+    def _pair_hashes(self, s, v, o, n):
+        return counters.hash_unordered_pairs(s, o)
@@ -0,0 +1,98 @@
+"""Opt-in profilers for the execution of pipeline steps
+"""
+
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+from collections import defaultdict
+
+
+logger = logging.getLogger(__name__)
+
+
+class CProfileProfiler:
+    """Deterministic profiler, dumps a pstats file
+    (readable by pstats, snakeviz or gprof2dot)
+    """
+    extension = 'prof'
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self, path):
+        self._profile.dump_stats(path)
+
+
+class SamplingProfiler:
+    """Samples the stack of the profiled thread at a fixed interval.
+
+    Dumps the samples in the collapsed stack format,
+    as consumed by flamegraph.pl and speedscope
+    """
+    extension = 'folded'
+
+    def __init__(self, interval=0.005):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        self.interval = interval
+        self.samples = defaultdict(lambda: 0)
+        self._thread_id = None
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def dump(self, path):
+        with open(path, 'w') as output_handle:
+            for stack, count in sorted(self.samples.items()):
+                output_handle.write(f'{stack} {count}\n')
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                stack.append(f'{code.co_name} '
+                             f'({filename}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+PROFILERS = {'cprofile': CProfileProfiler,
+             'sampling': SamplingProfiler}
+
+
+def profiled_call(profiler_name, path, function, **kwargs):
+    """Calls the function under the named profiler,
+    dumping the profile to path (plus the profiler file extension)
+    """
+    profiler = PROFILERS[profiler_name]()
+    output_path = f'{path}.{profiler.extension}'
+
+    profiler.start()
+    try:
+        return function(**kwargs)
+    finally:
+        profiler.stop()
+        profiler.dump(output_path)
+        logger.info(f'Profile written to {output_path}')
@@ -0,0 +1,297 @@
+"""Progress and ETA reporting of long runs
+"""
+
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+HISTORY_LENGTH = 20
+
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+def tick(count=1, unit='lines'):
+    """Counts work done by the step running in this thread
+    (a no-op when no reporter is watching it)
+    """
+    step = getattr(_current, 'step', None)
+    if step is not None:
+        step.add(count, unit)
+
+
+class StepProgress:
+    """Counts of the work done by a running step
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.counts = {}
+
+    def add(self, count, unit):
+        self.counts[unit] = self.counts.get(unit, 0) + count
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def status(self, expected=None):
+        elapsed = self.elapsed()
+        status = {'name': self.name,
+                  'state': 'running' if self.finished is None else 'finished',
+                  'elapsed': elapsed,
+                  'counts': dict(self.counts),
+                  'rates': {unit: count / elapsed if elapsed else None
+                            for unit, count in self.counts.items()}}
+        if expected is not None:
+            status['expected'] = expected
+        return status
+
+
+class ProgressReporter:
+    """Keeps track of the steps run by experiments (see
+    Experiment(reporter=...)) and of the work they report through tick.
+
+    Once started, writes the status (see status) as JSON to status_path
+    every interval seconds, and serves it on http://127.0.0.1:http_port
+    when a port is given.
+
+    The ETA uses the mean duration of each step in earlier runs,
+    kept in the JSON file history_path
+    """
+    def __init__(self, status_path=None, interval=5.0,
+                 history_path=None, http_port=None):
+        self.status_path = status_path
+        self.interval = interval
+        self.history_path = history_path
+        self.http_port = http_port
+        self.history = self._load_history()
+        self.run_info = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._pending_steps = []
+        self._steps = []
+        self._experiment_started = None
+        self._experiment_durations = []
+        self._stopped = threading.Event()
+        self._writer = None
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def set_run(self, **info):
+        """Run-level information shown in the status, such as the
+        pair being processed; pair_index (from 1) and pair_count
+        also extend the ETA to the remaining pairs
+        """
+        with self._lock:
+            self.run_info.update(info)
+
+    def begin_experiment(self, step_names):
+        """Starts tracking an experiment, which will run the steps
+        """
+        now = time.time()
+        with self._lock:
+            if self._experiment_started is not None:
+                self._experiment_durations.append(now -
+                                                  self._experiment_started)
+            self._experiment_started = now
+            self._pending_steps = list(step_names)
+            self._steps = []
+
+    def skip_step(self, name):
+        """The step will not run (its outputs are cached)
+        """
+        with self._lock:
+            if name in self._pending_steps:
+                self._pending_steps.remove(name)
+
+    @contextmanager
+    def step(self, name):
+        """Context of a step running in the current thread
+        """
+        step = StepProgress(name)
+        with self._lock:
+            if name in self._pending_steps:
+                self._pending_steps.remove(name)
+            self._steps.append(step)
+
+        previous = getattr(_current, 'step', None)
+        _current.step = step
+        try:
+            yield step
+        finally:
+            _current.step = previous
+            step.finished = time.time()
+            with self._lock:
+                durations = self.history.setdefault(name, [])
+                durations.append(step.elapsed())
+                del durations[:-HISTORY_LENGTH]
+
+    def expected_duration(self, name):
+        """Mean duration of the step in the history, None if unknown
+        """
+        durations = self.history.get(name)
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    def eta_seconds(self):
+        """Expected seconds to finish the current experiment and,
+        when pair_index and pair_count are set, the remaining pairs
+        """
+        with self._lock:
+            remaining = 0.0
+            for step in self._steps:
+                expected = self.expected_duration(step.name)
+                if step.finished is None and expected is not None:
+                    remaining += max(0.0, expected - step.elapsed())
+            remaining += sum(self.expected_duration(name) or 0.0
+                             for name in self._pending_steps)
+
+            pairs_left = (self.run_info.get('pair_count', 0)
+                          - self.run_info.get('pair_index', 0))
+            if pairs_left > 0:
+                if self._experiment_durations:
+                    per_pair = (sum(self._experiment_durations)
+                                / len(self._experiment_durations))
+                else:
+                    per_pair = sum(self.expected_duration(step.name) or 0.0
+                                   for step in self._steps)
+                    per_pair += sum(self.expected_duration(name) or 0.0
+                                    for name in self._pending_steps)
+                remaining += pairs_left * per_pair
+
+        return remaining
+
+    def status(self):
+        now = time.time()
+        eta_seconds = self.eta_seconds()
+        with self._lock:
+            steps = [step.status(self.expected_duration(step.name))
+                     for step in self._steps]
+            run_info = dict(self.run_info)
+            pending = list(self._pending_steps)
+
+        return {'updated': _timestamp(now),
+                'elapsed': now - self.started,
+                'run': run_info,
+                'steps': steps,
+                'pending_steps': pending,
+                'eta_seconds': eta_seconds,
+                'eta': _timestamp(now + eta_seconds)}
+
+    def start(self):
+        """Starts writing the status file and serving it over HTTP
+        """
+        self._stopped.clear()
+        if self.status_path is not None:
+            self._writer = threading.Thread(target=self._write_periodically,
+                                            daemon=True)
+            self._writer.start()
+
+        if self.http_port is not None:
+            self._server = ThreadingHTTPServer(('127.0.0.1', self.http_port),
+                                               _status_handler(self))
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+            logger.info(f'Serving progress on'
+                        f' http://127.0.0.1:{self._server.server_port}')
+
+    def stop(self):
+        """Stops reporting, writing the final status and the history
+        """
+        self._stopped.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.write_status()
+        self.save_history()
+
+    def write_status(self):
+        if self.status_path is not None:
+            _write_json(self.status_path, self.status())
+
+    def save_history(self):
+        if self.history_path is not None:
+            with self._lock:
+                history = {name: list(durations)
+                           for name, durations in self.history.items()}
+            _write_json(self.history_path, history)
+
+    def _write_periodically(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write_status()
+            except OSError as e:
+                logger.warning(f'Could not write the status: {e}')
+
+    def _load_history(self):
+        if self.history_path is None or not os.path.exists(self.history_path):
+            return {}
+        try:
+            with open(self.history_path) as history_file:
+                return json.load(history_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring the timing history'
+                           f' {self.history_path}: {e}')
+            return {}
+
+
+@contextmanager
+def step_context(reporter, name):
+    """reporter.step(name), or nothing when there is no reporter
+    """
+    if reporter is None:
+        yield None
+    else:
+        with reporter.step(name) as step:
+            yield step
+
+
+def _status_handler(reporter):
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(reporter.status(), indent=2).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return StatusHandler
+
+
+def _timestamp(seconds):
+    moment = datetime.datetime.fromtimestamp(seconds)
+    return moment.isoformat(timespec='seconds')
+
+
+def _write_json(path, content):
+    """Writes the file atomically, so readers never see half of it
+    """
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as output:
+        json.dump(content, output, indent=2)
+    os.replace(temporary_path, path)
@@ -1,18 +1,23 @@
+"""Runs the NCM pipeline over category pairs; see cli for the
+command line (python run.py --help)
+
+Heavy modules (pandas, networkx, the steps) are imported by the
+functions needing them, so the command line starts quickly
+"""
+
+
+import argparse
 import datetime
+import json
 import logging
 import os
 from collections import namedtuple
-from typing import Dict, List, Tuple
-
-import experiment
-
-import ncm
+from typing import Dict, List, TYPE_CHECKING, Tuple
 
-import numpy as np
+import progress
 
-import pandas as pd
-
-import preproc
+if TYPE_CHECKING:
+    import numpy as np
 
 
 CACHE_DIR = os.path.expanduser('~/data/ontext_experiments/cache')
@@ -22,6 +27,9 @@ OUTPUT_BASE_DIR = os.path.expanduser('~/data/ontext_experiments')
 DATETIME_FORMAT = '%Y_%m_%d.%H_%M_%S'
 LOGGING_FORMAT = '%(levelname)s %(asctime)s %(funcName)s\t%(message)s'
 CATEGORIES_TABLE = os.path.expanduser('~/data/mall/Filt-Relations100')
+TIMING_HISTORY = os.path.join(OUTPUT_BASE_DIR, 'step_timings.json')
+RUN_OPTIONS = 'run.json'
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
 
 
 Relation = namedtuple('Relation', ['cat1', 'cat2', 'name',
@@ -97,6 +105,8 @@ class BuildOutputReports:
               unique_contexts: 'np.array[str]',
               promoted_pairs: List[List[Tuple[str, str]]],
               **kwargs):
+        import numpy as np
+
         relations: List[Relation] = []
         contexts: List[Context] = []
 
@@ -131,62 +141,290 @@ class BuildOutputReports:
                 'contexts_output': contexts}
 
 
-def run(category_pairs, output_dir):
+def route_category_pairs(category_pairs, output_dir, categories,
+                         preprocessing_steps, seed=None, reporter=None):
+    """Preprocesses the SVO and splits it for all the category pairs
+    in a single scan; returns the path of the SVO of each pair
+    """
+    import experiment
+    import preproc
+
+    category_pairs = list(dict.fromkeys(category_pairs))
+    steps = preprocessing_steps + (
+        preproc.RouteInstancesToPairs(category_pairs, categories),)
+
+    exp = experiment.Experiment(os.path.join(output_dir, 'routing'),
+                                CACHE_DIR,
+                                steps=steps,
+                                prefix='vpreptriples',
+                                seed=seed,
+                                reporter=reporter)
+    exp.add_file('raw_svo', BASE_SVO)
+    exp.add_file('svo', BASE_SVO)
+    exp.prepare()
+    exp.execute_all()
+
+    return {(cat1, cat2): exp.files[preproc.routed_svo_name(cat1, cat2)]
+            for cat1, cat2 in category_pairs}
+
+
+PipelineSteps = namedtuple('PipelineSteps', ['filter_sentences',
+                                             'pair_occurrence',
+                                             'instance_in_category',
+                                             'context_occurrence',
+                                             'svo_to_memory',
+                                             'cooccurrence_graph'])
+
+
+def pipeline_steps(use_spark=False):
+    """The step classes of the pipeline, run in Spark or not
+    """
+    import experiment
+    import ncm
+    import preproc
+
+    if use_spark:
+        import spark_matrix
+        return PipelineSteps(spark_matrix.SparkFilterSentencesByOccurrence,
+                             spark_matrix.SparkMinimumPairOccurrence,
+                             spark_matrix.SparkFilterInstanceInCategory,
+                             spark_matrix.SparkMinimumContextOccurrence,
+                             spark_matrix.SparkSvoToMemory,
+                             spark_matrix.SparkBuildCooccurrenceGraph)
+
+    return PipelineSteps(preproc.FilterSentencesByOccurrence,
+                         preproc.MinimumPairOccurrence,
+                         preproc.FilterInstanceInCategory,
+                         preproc.MinimumContextOccurrence,
+                         experiment.SvoToMemory,
+                         ncm.BuildCooccurrenceGraph)
+
+
+def pair_steps(step_classes, preprocessing, shard_ncm=False, workers=None):
+    """The steps of a category pair: its preprocessing steps,
+    then the NCM (see run), sharded on workers processes
+    """
+    import ncm
+
+    if shard_ncm:
+        clustering_steps = (ncm.ShardedNcm(5, workers=workers),)
+    else:
+        clustering_steps = (ncm.Spanner(5), ncm.NcmHcsw(), ncm.Medoids())
+
+    return (tuple(preprocessing)
+            + (step_classes.context_occurrence(3),
+               step_classes.svo_to_memory(),
+               step_classes.cooccurrence_graph())
+            + clustering_steps
+            + (ncm.PromotePairs(),
+               ncm.Pruner(),
+               BuildOutputReports()))
+
+
+def preprocessed_prefix(preprocessing_steps, name):
+    """Cache prefix of the SVO made by the preprocessing steps
+    and then split per pair by name
+    """
+    return '.'.join(['vpreptriples']
+                    + [str(step) for step in preprocessing_steps]
+                    + [name])
+
+
+def pair_pipeline(cat1, cat2, step_classes, categories, shard_ncm=False,
+                  routed_prefix=None, workers=None):
+    """The steps and cache prefix of the category pair. With
+    a routed_prefix, the cache prefix of an SVO already split
+    per pair (as by route_category_pairs), only the categories
+    are read; else the pair filters the base SVO itself
+    """
+    import experiment
+
+    read_categories = experiment.ReadCategories(
+        os.path.join(CATEGORY_DIR, cat1),
+        os.path.join(CATEGORY_DIR, cat2),
+        store=categories)
+    if routed_prefix is not None:
+        preprocessing = (read_categories,)
+        prefix = routed_prefix
+    else:
+        preprocessing = (step_classes.filter_sentences(5),
+                         step_classes.pair_occurrence(5),
+                         read_categories,
+                         step_classes.instance_in_category())
+        prefix = 'vpreptriples'
+
+    return (pair_steps(step_classes, preprocessing, shard_ncm, workers),
+            prefix)
+
+
+def run_pair(cat1, cat2, output_dir, steps, svo, prefix,
+             workers=1, **experiment_options):
+    """Runs the steps of the category pair on the svo;
+    returns the experiment, whose data has the
+    relations_output and contexts_output
+    (its shared memory, if any, already unlinked)
+    """
+    import experiment
+
+    with experiment.Experiment(output_dir,
+                               CACHE_DIR,
+                               steps=steps,
+                               prefix=prefix,
+                               **experiment_options) as exp:
+        exp.add_file('raw_svo', BASE_SVO)
+        exp.add_file('svo', svo)
+        exp.data['cat1_name'] = cat1
+        exp.data['cat2_name'] = cat2
+        exp.prepare()
+        exp.execute_all(workers=workers)
+    return exp
+
+
+def run(category_pairs, output_dir,
+        profile_steps=None, profile_pairs=None, profiler='cprofile',
+        workers=1, release_data=None, use_spark=False, route=False,
+        shard_ncm=False, seed=None, progress_port=None, memory_budget=None,
+        share_arrays=False, resume=False):
+    """Runs the NCM pipeline for each category pair,
+    with independent steps of a pair running on up to workers threads.
+
+    The steps named in profile_steps are profiled,
+    only for the pairs in profile_pairs (or all pairs if it is None)
+
+    release_data ('drop' or 'spill') frees the intermediate data
+    of a pair as soon as no step needs it anymore
+
+    use_spark runs the preprocessing, the loading of the SVO and
+    the co-occurrence counting in Spark (local mode by default)
+
+    route filters the SVO for all the pairs in a single scan,
+    instead of one scan per pair
+
+    shard_ncm clusters the connected components of the cograph
+    in a pool of workers processes (see ncm.ShardedNcm)
+
+    seed is given to every randomised step, making the results
+    (and so the cache) reproducible
+
+    memory_budget (bytes) moves the large structures of a pair
+    to disk when they are estimated to exceed it (see Experiment)
+
+    share_arrays moves the NumPy arrays of a pair to shared memory,
+    unlinked once the pair is done (see Experiment)
+
+    The progress of the run (current pair and step, throughput, ETA)
+    is written to status.json in the output directory, and served on
+    http://127.0.0.1:progress_port when a port is given
+
+    The relations and contexts of each pair are written to CSVs in its
+    directory, and those of all pairs to CSVs in output_dir.
+    resume skips the pairs whose CSVs were already written
+    """
+    import category_store
+
+    step_classes = pipeline_steps(use_spark)
+
     relations: List[Relation] = []
     contexts: List[Context] = []
-
-    for i, (cat1, cat2) in enumerate(category_pairs, 1):
-        logger.info(f'{cat1} x {cat2} ({i / len(category_pairs):.2%})')
-        try:
-            directory_name = '_'.join([cat1, cat2])
-            cat1_dir = os.path.join(CATEGORY_DIR, cat1)
-            cat2_dir = os.path.join(CATEGORY_DIR, cat2)
-            pair_output_dir = os.path.join(output_dir, directory_name)
-
-            steps = (preproc.FilterSentencesByOccurrence(5),
-                     preproc.MinimumPairOccurrence(5),
-                     experiment.ReadCategories(cat1_dir, cat2_dir),
-                     preproc.FilterInstanceInCategory(),
-                     preproc.MinimumContextOccurrence(3),
-                     experiment.SvoToMemory(),
-                     ncm.BuildCooccurrenceGraph(),
-                     ncm.Spanner(5),
-                     ncm.NcmHcsw(),
-                     ncm.Medoids(),
-                     ncm.PromotePairs(),
-                     ncm.Pruner(),
-                     BuildOutputReports())
-
-            exp = experiment.Experiment(pair_output_dir,
-                                        CACHE_DIR,
-                                        steps=steps,
-                                        prefix='vpreptriples')
-
-            exp.add_file('raw_svo', BASE_SVO)
-            exp.add_file('svo', BASE_SVO)
-            exp.data['cat1_name'] = cat1
-            exp.data['cat2_name'] = cat2
-            exp.prepare()
-            exp.execute_all()
-
-            relations.extend(exp.data['relations_output'])
-            contexts.extend(exp.data['contexts_output'])
-        except Exception as e:
-            logger.critical(f'Category pair {cat1}, {cat2} failed')
-            logger.critical(e)
-
-    pd.DataFrame(relations).to_csv(output_dir + '/relations.csv', index=False)
-    pd.DataFrame(contexts).to_csv(output_dir + '/contexts.csv', index=False)
+    exp = None
+    categories = category_store.CategoryStore(CATEGORY_DIR)
+    reporter = progress.ProgressReporter(
+        os.path.join(output_dir, 'status.json'),
+        history_path=TIMING_HISTORY,
+        http_port=progress_port)
+    reporter.start()
+
+    try:
+        routed_prefix = None
+        if route:
+            preprocessing_steps = (step_classes.filter_sentences(5),
+                                   step_classes.pair_occurrence(5))
+            routed_svo = route_category_pairs(category_pairs, output_dir,
+                                              categories, preprocessing_steps,
+                                              seed=seed, reporter=reporter)
+            routed_prefix = preprocessed_prefix(preprocessing_steps,
+                                                'Routed')
+
+        for i, (cat1, cat2) in enumerate(category_pairs, 1):
+            logger.info(f'{cat1} x {cat2} ({i / len(category_pairs):.2%})')
+            reporter.set_run(pair=f'{cat1} x {cat2}', pair_index=i,
+                             pair_count=len(category_pairs))
+            pair_output_dir = os.path.join(output_dir, '_'.join([cat1, cat2]))
+            relations_path = os.path.join(pair_output_dir, 'relations.csv')
+            contexts_path = os.path.join(pair_output_dir, 'contexts.csv')
+            if (resume and os.path.exists(relations_path)
+                    and os.path.exists(contexts_path)):
+                logger.info(f'{cat1} x {cat2} already done')
+                relations.extend(read_results(relations_path, Relation))
+                contexts.extend(read_results(contexts_path, Context))
+                continue
+
+            try:
+                steps, prefix = pair_pipeline(cat1, cat2, step_classes,
+                                              categories, shard_ncm,
+                                              routed_prefix, workers)
+                if route:
+                    pair_svo = routed_svo[cat1, cat2]
+                else:
+                    pair_svo = BASE_SVO
+
+                if profile_pairs is None or (cat1, cat2) in profile_pairs:
+                    pair_profile_steps = profile_steps
+                else:
+                    pair_profile_steps = None
+
+                exp = run_pair(cat1, cat2, pair_output_dir, steps,
+                               pair_svo, prefix,
+                               workers=workers,
+                               profile_steps=pair_profile_steps,
+                               profiler=profiler,
+                               release_data=release_data,
+                               seed=seed,
+                               reporter=reporter,
+                               memory_budget=memory_budget,
+                               share_arrays=share_arrays)
+
+                write_results(contexts_path, exp.data['contexts_output'],
+                              Context)
+                write_results(relations_path, exp.data['relations_output'],
+                              Relation)
+                relations.extend(exp.data['relations_output'])
+                contexts.extend(exp.data['contexts_output'])
+            except Exception as e:
+                logger.critical(f'Category pair {cat1}, {cat2} failed')
+                logger.critical(e)
+    finally:
+        reporter.stop()
+
+    write_results(os.path.join(output_dir, 'relations.csv'),
+                  relations, Relation)
+    write_results(os.path.join(output_dir, 'contexts.csv'),
+                  contexts, Context)
 
     return exp
 
 
-def main(category_pairs: List[Tuple[str, str]] = None):
-    now = datetime.datetime.now().strftime(DATETIME_FORMAT)
-    output_dir = os.path.join(OUTPUT_BASE_DIR, now)
-    if not os.path.exists(output_dir):
-        os.mkdir(output_dir)
+def write_results(path, rows, row_type):
+    """Writes the Relation or Context rows as a CSV
+    """
+    import pandas as pd
+
+    pd.DataFrame(rows, columns=row_type._fields).to_csv(path, index=False)
+
+
+def read_results(path, row_type):
+    """The Relation or Context rows of a CSV written by write_results
+    """
+    import pandas as pd
 
+    table = pd.read_csv(path, keep_default_na=False)
+    return [row_type(*row) for row in table.itertuples(index=False)]
+
+
+def setup_logging(output_dir):
+    """Logs everything to the log file of output_dir,
+    and the INFO messages to stdout
+    """
     logging_formatter = logging.Formatter(LOGGING_FORMAT)
     logging_file = os.path.join(output_dir, 'log')
 
@@ -200,18 +438,220 @@ def main(category_pairs: List[Tuple[str, str]] = None):
 
     logging.getLogger('').addHandler(stdout_handle)
 
+
+def read_category_pairs():
+    """The category pairs of CATEGORIES_TABLE
+    """
+    import pandas as pd
+
+    category_pairs_table = pd.read_table(CATEGORIES_TABLE,
+                                         sep='  ',
+                                         header=None,
+                                         engine='python',
+                                         names=['cat1', 'cat2', 'score'],
+                                         usecols=['cat1', 'cat2'])
+    return category_pairs_table.apply(tuple, axis='columns').tolist()
+
+
+def main(category_pairs: List[Tuple[str, str]] = None,
+         profile_steps: List[str] = None,
+         profile_pairs: List[Tuple[str, str]] = None,
+         profiler: str = 'cprofile',
+         workers: int = 1,
+         release_data: str = None,
+         use_spark: bool = False,
+         route: bool = False,
+         shard_ncm: bool = False,
+         seed: int = None,
+         progress_port: int = None,
+         memory_budget: int = None,
+         share_arrays: bool = False):
+    now = datetime.datetime.now().strftime(DATETIME_FORMAT)
+    output_dir = os.path.join(OUTPUT_BASE_DIR, now)
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    setup_logging(output_dir)
+
     if category_pairs is None:
-        category_pairs_table = pd.read_table(CATEGORIES_TABLE,
-                                             sep='  ',
-                                             header=None,
-                                             engine='python',
-                                             names=['cat1', 'cat2', 'score'],
-                                             usecols=['cat1', 'cat2'])
-        category_pairs = (category_pairs_table.apply(tuple, axis='columns')
-                                              .tolist())
+        category_pairs = read_category_pairs()
+
+    options = {'category_pairs': category_pairs,
+               'profile_steps': profile_steps,
+               'profile_pairs': profile_pairs,
+               'profiler': profiler,
+               'workers': workers,
+               'release_data': release_data,
+               'use_spark': use_spark,
+               'route': route,
+               'shard_ncm': shard_ncm,
+               'seed': seed,
+               'progress_port': progress_port,
+               'memory_budget': memory_budget,
+               'share_arrays': share_arrays}
+    with open(os.path.join(output_dir, RUN_OPTIONS), 'w') as options_file:
+        json.dump(options, options_file, indent=2)
+
+    return run(output_dir=output_dir, **options)
+
+
+def resume(output_dir):
+    """Continues the run (started by main) in output_dir,
+    with its options, skipping the pairs it finished
+    """
+    output_dir = os.path.expanduser(output_dir)
+    setup_logging(output_dir)
+
+    with open(os.path.join(output_dir, RUN_OPTIONS)) as options_file:
+        options = json.load(options_file)
+    for pairs_option in ('category_pairs', 'profile_pairs'):
+        if options[pairs_option] is not None:
+            options[pairs_option] = [tuple(pair)
+                                     for pair in options[pairs_option]]
+
+    return run(output_dir=output_dir, resume=True, **options)
+
+
+def describe_run(category_pairs, use_spark=False, route=False,
+                 shard_ncm=False, seed=None):
+    """Lines describing what a run would do: the steps
+    of each pair, marking those whose outputs are cached
+    (the seed of randomised steps being part of their cache key)
+    """
+    import category_store
+    import experiment
+
+    step_classes = pipeline_steps(use_spark)
+    categories = category_store.CategoryStore(CATEGORY_DIR)
+    lines = [f'{len(category_pairs)} category pairs, cache in {CACHE_DIR}']
+
+    routed_prefix = None
+    if route:
+        preprocessing_steps = (step_classes.filter_sentences(5),
+                               step_classes.pair_occurrence(5))
+        routed_prefix = preprocessed_prefix(preprocessing_steps, 'Routed')
+        lines.append('routing: ' + ', '.join(
+            str(step) for step in preprocessing_steps))
+
+    for cat1, cat2 in category_pairs:
+        steps, prefix = pair_pipeline(cat1, cat2, step_classes, categories,
+                                      shard_ncm, routed_prefix)
+        exp = experiment.Experiment(OUTPUT_BASE_DIR, CACHE_DIR, steps,
+                                    prefix=prefix, seed=seed)
+        lines.append(f'{cat1} x {cat2}:')
+        lines.extend(f'  {"cached" if cached else "      "} {step}'
+                     for step, cached in exp.cache_status())
+
+    return lines
+
+
+def collect_cache_garbage(cache_dir=CACHE_DIR, dry_run=False):
+    """Removes the entries of the cache whose outputs were deleted
+    (dangling symbolic links), or are selections whose physical SVO
+    was deleted; returns their names
+    """
+    import svo_io
+
+    dangling = []
+    for name in sorted(os.listdir(cache_dir)):
+        path = os.path.join(cache_dir, name)
+        if os.path.islink(path) and not svo_io.is_available(path):
+            dangling.append(name)
+            if not dry_run:
+                os.remove(path)
+    return dangling
+
 
-    return run(category_pairs, output_dir)
+def parse_size(size):
+    """Bytes of a size such as 512M or 8G (or a plain number)
+    """
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def cli(argv=None):
+    """Command line: run, resume, bench and cache-gc
+    """
+    parser = argparse.ArgumentParser(
+        description='Relation extraction from SVO co-occurrences')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser(
+        'run', help='run the pipeline for category pairs')
+    run_parser.add_argument(
+        '--pair', dest='category_pairs', nargs=2, action='append',
+        metavar=('CAT1', 'CAT2'),
+        help=f'category pair to run (default: those of {CATEGORIES_TABLE})')
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--release-data', choices=('drop', 'spill'))
+    run_parser.add_argument('--spark', dest='use_spark',
+                            action='store_true')
+    run_parser.add_argument('--route', action='store_true')
+    run_parser.add_argument('--shard-ncm', action='store_true')
+    run_parser.add_argument('--seed', type=int)
+    run_parser.add_argument('--progress-port', type=int)
+    run_parser.add_argument('--memory-budget', type=parse_size,
+                            help='such as 8G')
+    run_parser.add_argument('--share-arrays', action='store_true',
+                            help='keep the arrays of a pair'
+                                 ' in shared memory')
+    run_parser.add_argument('--profile-step', dest='profile_steps',
+                            action='append', metavar='STEP')
+    run_parser.add_argument('--profile-pair', dest='profile_pairs',
+                            nargs=2, action='append',
+                            metavar=('CAT1', 'CAT2'))
+    run_parser.add_argument('--profiler', default='cprofile',
+                            choices=('cprofile', 'sampling'))
+    run_parser.add_argument('--dry-run', action='store_true',
+                            help='only show the steps and the cache hits')
+
+    resume_parser = commands.add_parser(
+        'resume', help='continue an interrupted run')
+    resume_parser.add_argument('output_dir')
+
+    bench_parser = commands.add_parser(
+        'bench', help='benchmark the steps on synthetic data')
+    bench_parser.add_argument('--repeat', type=int, default=3)
+    bench_parser.add_argument('--seed', type=int, default=0)
+    bench_parser.add_argument('--output', dest='output_path')
+
+    gc_parser = commands.add_parser(
+        'cache-gc', help='remove the cache entries of deleted outputs')
+    gc_parser.add_argument('--dry-run', action='store_true',
+                           help='only list them')
+
+    args = vars(parser.parse_args(argv))
+    command = args.pop('command')
+
+    if command == 'run':
+        for pairs_option in ('category_pairs', 'profile_pairs'):
+            if args[pairs_option] is not None:
+                args[pairs_option] = [tuple(pair)
+                                      for pair in args[pairs_option]]
+        if args.pop('dry_run'):
+            category_pairs = args['category_pairs'] or read_category_pairs()
+            print('\n'.join(describe_run(category_pairs,
+                                         use_spark=args['use_spark'],
+                                         route=args['route'],
+                                         shard_ncm=args['shard_ncm'],
+                                         seed=args['seed'])))
+            return
+        main(**args)
+    elif command == 'resume':
+        resume(args['output_dir'])
+    elif command == 'bench':
+        import benchmark
+        print(benchmark.main(**args))
+    else:
+        dangling = collect_cache_garbage(dry_run=args['dry_run'])
+        for name in dangling:
+            print(name)
+        action = 'Found' if args['dry_run'] else 'Removed'
+        print(f'{action} {len(dangling)} dangling cache entries'
+              f' in {CACHE_DIR}')
 
 
 if __name__ == '__main__':
-    main()
+    cli()
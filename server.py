@@ -0,0 +1,310 @@
+"""Long-lived pipeline server, keeping the preprocessed SVO,
+its instance index and the categories in memory between jobs
+"""
+
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import category_store
+
+import experiment
+
+import numpy as np
+
+import pandas as pd
+
+import run
+
+import svo_io
+
+
+DEFAULT_PORT = 8765
+
+
+logger = logging.getLogger(__name__)
+
+
+class SvoIndex:
+    """The SVO held in memory, with its lines sorted by subject
+    and by object vocabulary id, so the sentences of a category pair
+    are found without reading the SVO again.
+
+    Every instance of the SVO is interned in the vocabulary,
+    so categories loaded later share its ids
+    """
+    def __init__(self, svo, vocabulary, chunk_size=svo_io.LINES_PER_CHUNK):
+        columns = list(zip(*svo_io.read_chunks(svo, chunk_size)))
+        if columns:
+            self.s, self.v, self.o, self.n = (np.concatenate(column)
+                                              for column in columns)
+        else:
+            self.s, self.v, self.o = (np.empty(0, dtype=object)
+                                      for _ in range(3))
+            self.n = np.empty(0, dtype=np.int64)
+
+        codes, instances = pd.factorize(np.concatenate([self.s, self.o]))
+        ids = np.fromiter((vocabulary.intern(name) for name in instances),
+                          dtype=np.int64, count=len(instances))
+        self.s_ids = ids[codes[:len(self.s)]]
+        self.o_ids = ids[codes[len(self.s):]]
+
+        # line numbers sorted by id, and the sorted ids
+        self._by_s = np.argsort(self.s_ids, kind='stable')
+        self._sorted_s = self.s_ids[self._by_s]
+        self._by_o = np.argsort(self.o_ids, kind='stable')
+        self._sorted_o = self.o_ids[self._by_o]
+        logger.info(f'Indexed {len(self.s)} SVO lines'
+                    f' of {len(instances)} instances')
+
+    def __len__(self):
+        return len(self.s)
+
+    def pair_lines(self, store, cat1, cat2, reverse=True):
+        """Sorted numbers of the lines within the two categories
+        of the category_store.CategoryStore, as kept by
+        preproc.FilterInstanceInCategory
+        """
+        lines = self._lines_between(self._by_s, self._sorted_s, self.o_ids,
+                                    store, cat1, cat2)
+        if reverse:
+            lines = np.union1d(lines,
+                               self._lines_between(self._by_o,
+                                                   self._sorted_o,
+                                                   self.s_ids, store,
+                                                   cat1, cat2))
+        return lines
+
+    def write(self, path, lines, compression=None):
+        """Writes the lines (numbers) of the SVO to path
+        """
+        with svo_io.open_svo(path, 'w', compression=compression) as output:
+            for start in range(0, len(lines), svo_io.LINES_PER_CHUNK):
+                chunk = lines[start:start + svo_io.LINES_PER_CHUNK]
+                output.writelines(f'{s}\t{v}\t{o}\t{n}\n'
+                                  for s, v, o, n in zip(self.s[chunk],
+                                                        self.v[chunk],
+                                                        self.o[chunk],
+                                                        self.n[chunk]))
+
+    def _lines_between(self, order, sorted_ids, other_ids, store, category,
+                       other_category):
+        """Lines whose id is in the category and other id in the
+        other category; order sorts the line numbers by id,
+        into sorted_ids
+        """
+        category_ids = store.ids(category)
+        starts = np.searchsorted(sorted_ids, category_ids, side='left')
+        ends = np.searchsorted(sorted_ids, category_ids, side='right')
+        lines = np.concatenate([np.empty(0, dtype=np.int64)]
+                               + [order[start:end]
+                                  for start, end in zip(starts, ends)
+                                  if start < end])
+        return lines[store.contains(other_category, other_ids[lines])]
+
+
+class PipelineServer:
+    """Runs category pair jobs (see run_job) against state
+    loaded once: the preprocessed SVO, indexed by instance
+    (see SvoIndex), and the category store.
+
+    Jobs are run one at a time, each in its own directory
+    of output_dir, with the steps of run.run; the status
+    is answered while a job runs
+    """
+    def __init__(self, output_dir, port=DEFAULT_PORT, workers=1,
+                 shard_ncm=False, seed=None, memory_budget=None):
+        self.output_dir = os.path.expanduser(output_dir)
+        self.port = port
+        self.workers = workers
+        self.shard_ncm = shard_ncm
+        self.seed = seed
+        self.memory_budget = memory_budget
+        self.categories = category_store.CategoryStore(run.CATEGORY_DIR)
+        self.step_classes = run.pipeline_steps()
+        self.preprocessing_steps = (self.step_classes.filter_sentences(5),
+                                    self.step_classes.pair_occurrence(5))
+        self.prefix = run.preprocessed_prefix(self.preprocessing_steps,
+                                              'Indexed')
+        self.jobs_run = 0
+        self.started = None
+        self.index = None
+        self._lock = threading.Lock()
+        self._status_lock = threading.Lock()
+        self._server = None
+
+    def load(self):
+        """Preprocesses (or takes from the cache) the SVO
+        and indexes it
+        """
+        exp = experiment.Experiment(os.path.join(self.output_dir,
+                                                 'preprocessing'),
+                                    run.CACHE_DIR,
+                                    steps=self.preprocessing_steps,
+                                    prefix='vpreptriples',
+                                    seed=self.seed)
+        exp.add_file('raw_svo', run.BASE_SVO)
+        exp.add_file('svo', run.BASE_SVO)
+        exp.prepare()
+        exp.execute_all()
+
+        self.index = SvoIndex(exp.files['svo'], self.categories.vocabulary)
+
+    def run_job(self, cat1, cat2):
+        """Runs the NCM for the category pair, returning
+        its relations and contexts (as lists of dicts)
+        """
+        self.check_categories(cat1, cat2)
+        with self._lock:
+            with self._status_lock:
+                self.jobs_run += 1
+                job_number = self.jobs_run
+            job_dir = os.path.join(self.output_dir, 'jobs',
+                                   f'{job_number}_{cat1}_{cat2}')
+            os.makedirs(job_dir)
+
+            pair_svo = os.path.join(job_dir, 'svo')
+            self.index.write(pair_svo,
+                             self.index.pair_lines(self.categories,
+                                                   cat1, cat2))
+
+            steps, prefix = run.pair_pipeline(cat1, cat2, self.step_classes,
+                                              self.categories,
+                                              self.shard_ncm,
+                                              routed_prefix=self.prefix,
+                                              workers=self.workers)
+
+            exp = run.run_pair(cat1, cat2, os.path.join(job_dir, 'pipeline'),
+                               steps, pair_svo, prefix,
+                               workers=self.workers,
+                               seed=self.seed,
+                               memory_budget=self.memory_budget)
+
+        return {'relations': [relation._asdict()
+                              for relation in exp.data['relations_output']],
+                'contexts': [context._asdict()
+                             for context in exp.data['contexts_output']]}
+
+    def check_categories(self, *categories):
+        """Raises ValueError unless the categories are names
+        of files of run.CATEGORY_DIR
+        """
+        known = set(os.listdir(run.CATEGORY_DIR))
+        for category in categories:
+            if (not isinstance(category, str)
+                    or os.path.basename(category) != category
+                    or category not in known):
+                raise ValueError(f'Unknown category {category!r}')
+
+    def load_categories(self, *categories):
+        """Loads the categories of a job before running it,
+        failing (with a ValueError) for unknown categories
+        """
+        self.check_categories(*categories)
+        with self._lock:
+            for category in categories:
+                with self._status_lock:
+                    self.categories.load(category)
+
+    def status(self):
+        with self._status_lock:
+            return {'started': self.started,
+                    'svo_lines': len(self.index),
+                    'categories_loaded': self.categories.categories(),
+                    'jobs_run': self.jobs_run}
+
+    def serve_forever(self):
+        """Loads the state, then serves on http://127.0.0.1:port:
+        POST / with a JSON {"cat1": ..., "cat2": ...} runs the job,
+        answering its result as JSON; GET / answers the status
+        """
+        self.load()
+        self.started = datetime.datetime.now().isoformat(timespec='seconds')
+        self._server = ThreadingHTTPServer(('127.0.0.1', self.port),
+                                           _job_handler(self))
+        logger.info(f'Serving jobs on'
+                    f' http://127.0.0.1:{self._server.server_port}')
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+def _job_handler(server):
+    class JobHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self._answer(200, server.status())
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                job = json.loads(self.rfile.read(length))
+                cat1 = job['cat1']
+                cat2 = job['cat2']
+                server.load_categories(cat1, cat2)
+            except (ValueError, KeyError, TypeError, OSError) as e:
+                self._answer(400, {'error': f'Invalid job: {e}'})
+                return
+
+            logger.info(f'Job {cat1} x {cat2}')
+            started = time.time()
+            try:
+                result = server.run_job(cat1, cat2)
+            except Exception as e:
+                logger.exception(f'Job {cat1} x {cat2} failed')
+                self._answer(500, {'error': repr(e)})
+                return
+            result['seconds'] = time.time() - started
+            self._answer(200, result)
+
+        def _answer(self, code, content):
+            body = json.dumps(content, default=_json_default).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return JobHandler
+
+
+def _json_default(value):
+    """NumPy values in the results, as Python values
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def main(port: int = DEFAULT_PORT,
+         workers: int = 1,
+         shard_ncm: bool = False,
+         seed: int = None,
+         memory_budget: int = None):
+    now = datetime.datetime.now().strftime(run.DATETIME_FORMAT)
+    output_dir = os.path.join(run.OUTPUT_BASE_DIR, f'server_{now}')
+    os.makedirs(output_dir, exist_ok=True)
+
+    logging.basicConfig(level=logging.INFO, format=run.LOGGING_FORMAT)
+
+    PipelineServer(output_dir, port=port, workers=workers,
+                   shard_ncm=shard_ncm, seed=seed,
+                   memory_budget=memory_budget).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
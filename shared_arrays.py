@@ -0,0 +1,117 @@
+"""Zero-copy sharing of NumPy arrays between processes
+"""
+
+
+import logging
+import weakref
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+SharedArray = namedtuple('SharedArray', ['block_name', 'shape', 'dtype'])
+
+
+logger = logging.getLogger(__name__)
+
+
+def shareable(value):
+    """Whether the value is an array that can live in shared memory
+    (object arrays hold pointers, which are meaningless elsewhere).
+
+    Memory-mapped arrays are left on disk, as they were put there
+    to keep within the memory budget
+    """
+    return (isinstance(value, np.ndarray) and value.dtype.kind != 'O'
+            and not memory_mapped(value))
+
+
+def memory_mapped(array):
+    """Whether the array is, or is a view of, an np.memmap
+    """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+
+class SharedArrayRegistry:
+    """Publishes arrays into shared memory blocks
+    owned (and unlinked in the end) by this process.
+
+    Workers receive the small, picklable handles
+    and attach to the blocks without copying.
+
+    A block is unlinked when unpublished, but only unmapped
+    once the arrays using it are freed
+    """
+    def __init__(self):
+        self._blocks = {}
+        self._arrays = {}
+        self.handles = {}
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def publish(self, key, array):
+        """Copies the array into a new shared block,
+        returns the array backed by the block
+        """
+        if key in self._blocks:
+            if self._arrays[key] is array:
+                return array
+            self.unpublish(key)
+        array = np.ascontiguousarray(array)
+
+        # blocks can not be empty
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(array.nbytes, 1))
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[...] = array
+        # unmapping the block while arrays use it would crash
+        weakref.finalize(shared, block.close)
+
+        self._blocks[key] = block
+        self._arrays[key] = shared
+        self.handles[key] = SharedArray(block.name, array.shape,
+                                        array.dtype.str)
+        logger.debug(f'Published {key} ({array.nbytes} bytes)'
+                     f' as {block.name}')
+
+        return shared
+
+    def unpublish(self, key):
+        block = self._blocks.pop(key)
+        del self._arrays[key]
+        del self.handles[key]
+        block.unlink()
+
+    def close(self):
+        for key in list(self._blocks):
+            self.unpublish(key)
+
+
+def attach_array(handle):
+    """The array published under the handle by another process,
+    backed by the shared block (which is unmapped once the array is freed)
+    """
+    block = shared_memory.SharedMemory(name=handle.block_name)
+    array = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype),
+                       buffer=block.buf)
+    weakref.finalize(array, block.close)
+    return array
+
+
+def attach(handles):
+    """Attaches to the published arrays, returns a dict
+    mapping each key of the handles to its array
+    """
+    return {key: attach_array(handle) for key, handle in handles.items()}
@@ -1,54 +1,387 @@
+"""Spark-backed equivalents of the pipeline steps
+"""
+
+
+import glob
+import logging
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+import experiment
+
+import ncm
+
+import networkx as nx
+
+import numpy as np
+
+import preproc
+
 import pyspark.sql.functions as f
 from pyspark.conf import SparkConf
 from pyspark.mllib.linalg.distributed import CoordinateMatrix, MatrixEntry
-from pyspark.sql import SparkSession
+from pyspark.sql import SparkSession, Window
+
+from scipy import sparse
+
+import svo_io
+
+
+logger = logging.getLogger(__name__)
+
+_spark = None
+
+
+def get_spark():
+    """The SparkSession, started on first use
+    (local mode unless spark.master is configured)
+    """
+    global _spark
+    if _spark is None:
+        _spark = (SparkSession.builder
+                              .config(conf=SparkConf().setIfMissing(
+                                  'spark.master', 'local[*]'))
+                              .getOrCreate())
+    return _spark
+
+
+def category_table(categories):
+    """DataFrame of (category, instance) rows,
+    from a dict mapping category names to sets of instances
+    """
+    rows = [(category, instance)
+            for category, instances in categories.items()
+            for instance in instances]
+    return get_spark().createDataFrame(rows,
+                                       'category string, instance string')
+
+
+def load_categories(category_dir, category_pairs):
+    """Reads the instances of every category in the pairs, once each
+    """
+    categories = {}
+    for category in {c for pair in category_pairs for c in pair}:
+        path = os.path.join(os.path.expanduser(category_dir), category)
+        with open(path) as entries:
+            categories[category] = {entry.strip() for entry in entries}
+    return categories
+
 
+def cooccurrence_entries(svo_path: str, categories_df, category_pairs):
+    """Verb co-occurrence counts for many category pairs in one job.
 
-spark = SparkSession.builder.config(conf=SparkConf()).getOrCreate()
+    Sentences are matched to the category pairs by broadcast joins
+    against the category table, then every two different verbs
+    happening with the same (S, O) pair count one co-occurrence.
+
+    Returns the DataFrames of the entries (cat1, cat2, left_id,
+    right_id, count), with left_id < right_id, and of the verb ids
+    (cat1, cat2, verb, id); ids are in alphabetical order of the
+    verbs of each category pair, like unique_contexts
+    """
+    pairs_df = f.broadcast(get_spark().createDataFrame(
+        list(category_pairs), 'cat1 string, cat2 string'))
+    s_categories = f.broadcast(
+        categories_df.selectExpr('instance as s', 'category as s_category'))
+    o_categories = f.broadcast(
+        categories_df.selectExpr('instance as o', 'category as o_category'))
+
+    tagged_df = (with_pairs(read_svo(svo_path))
+                 .join(s_categories, 's')
+                 .join(o_categories, 'o'))
+
+    forward = ((f.col('s_category') == f.col('cat1'))
+               & (f.col('o_category') == f.col('cat2')))
+    backward = ((f.col('s_category') == f.col('cat2'))
+                & (f.col('o_category') == f.col('cat1')))
+
+    matched_df = (tagged_df.join(pairs_df, forward | backward)
+                           .select('cat1', 'cat2', 'line',
+                                   'pair_left', 'pair_right', 'v')
+                           .dropDuplicates(['cat1', 'cat2', 'line']))
+
+    verb_order = Window.partitionBy('cat1', 'cat2').orderBy('verb')
+    verb_ids_df = (matched_df.selectExpr('cat1', 'cat2', 'v as verb')
+                             .distinct()
+                             .withColumn('id',
+                                         f.dense_rank().over(verb_order) - 1)
+                             .cache())
+
+    group = ['cat1', 'cat2', 'pair_left', 'pair_right']
+    named_coords = (matched_df.selectExpr(*group, 'v as left_verb')
+                              .join(matched_df.selectExpr(*group,
+                                                          'v as right_verb'),
+                                    group)
+                              .filter('left_verb < right_verb')
+                              .groupby('cat1', 'cat2',
+                                       'left_verb', 'right_verb')
+                              .count())
+
+    left_ids = f.broadcast(verb_ids_df.selectExpr('cat1', 'cat2',
+                                                  'verb as left_verb',
+                                                  'id as left_id'))
+    right_ids = f.broadcast(verb_ids_df.selectExpr('cat1', 'cat2',
+                                                   'verb as right_verb',
+                                                   'id as right_id'))
+
+    entries_df = (named_coords.join(left_ids, ['cat1', 'cat2', 'left_verb'])
+                              .join(right_ids,
+                                    ['cat1', 'cat2', 'right_verb'])
+                              .select('cat1', 'cat2',
+                                      'left_id', 'right_id', 'count'))
+
+    return entries_df, verb_ids_df
+
+
+def build_matrices(svo_path: str, category_pairs, category_dir: str):
+    """Co-occurrence matrices of many category pairs, in one Spark job.
+
+    Returns a dict mapping each (cat1, cat2) to its unique_contexts
+    array and its upper-triangular co-occurrence scipy COO matrix
+    """
+    categories_df = category_table(load_categories(category_dir,
+                                                   category_pairs))
+    entries_df, verb_ids_df = cooccurrence_entries(svo_path, categories_df,
+                                                   category_pairs)
+
+    verbs = defaultdict(list)
+    for cat1, cat2, verb, verb_id in verb_ids_df.toLocalIterator():
+        verbs[cat1, cat2].append((verb_id, verb))
+
+    entries = defaultdict(list)
+    for cat1, cat2, left_id, right_id, count in entries_df.toLocalIterator():
+        entries[cat1, cat2].append((left_id, right_id, count))
+
+    matrices = {}
+    for category_pair in category_pairs:
+        category_pair = tuple(category_pair)
+        unique_contexts = np.array([verb for _, verb
+                                    in sorted(verbs[category_pair])])
+        n = len(unique_contexts)
+        coords = np.array(entries[category_pair],
+                          dtype=np.int64).reshape(-1, 3)
+        matrix = sparse.coo_matrix((coords[:, 2],
+                                    (coords[:, 0], coords[:, 1])),
+                                   shape=(n, n))
+        matrices[category_pair] = (unique_contexts, matrix)
+
+    return matrices
 
 
 def build_matrix(svo_path: str,
                  cat1_instances: set,
                  cat2_instances: set
                  ) -> CoordinateMatrix:
-    raw_df = spark.read.csv(svo_path, sep='\t')
-
-    pairs_df = (raw_df.filter((f.col('_c0').isin(cat1_instances)
-                              & f.col('_c2').isin(cat2_instances))
-                              | (f.col('_c0').isin(cat2_instances)
-                                 & f.col('_c2').isin(cat1_instances)))
-                      .rdd
-                      .map(lambda x: (tuple(sorted((x['_c0'], x['_c2']))),
-                                      x['_c1'],
-                                      int(x['_c3'])))
-                      .toDF(['pair', 'verb', 'n']))
-
-    named_coords = (pairs_df.selectExpr('pair', 'verb as left_verb', 'n')
-                            .join(pairs_df.selectExpr('pair',
-                                                      'verb as right_verb'),
-                                  'pair')
-                            .filter('left_verb < right_verb')
-                            .groupby(['left_verb', 'right_verb'])
-                            .count())
-
-    verb_to_id = (pairs_df.select('verb')
-                          .distinct()
-                          .rdd
-                          .zipWithIndex()
-                          .map(lambda r: [r[0].verb, r[1]])
-                          .toDF(['verb', 'id']))
-
-    coords = (named_coords.join(verb_to_id,
-                                named_coords.left_verb == verb_to_id.verb)
-                          .selectExpr('right_verb',
-                                      'id as left_verb_id',
-                                      'count')
-                          .join(verb_to_id,
-                                named_coords.right_verb == verb_to_id.verb)
-                          .selectExpr('left_verb_id',
-                                      'id as right_verb_id',
-                                      'count'))
-
-    matrix = CoordinateMatrix(coords.rdd.map(lambda c: MatrixEntry(*c)))
-
-    return matrix
+    categories_df = category_table({'cat1': cat1_instances,
+                                    'cat2': cat2_instances})
+    entries_df, _ = cooccurrence_entries(svo_path, categories_df,
+                                         [('cat1', 'cat2')])
+
+    coords = entries_df.select('left_id', 'right_id', 'count')
+
+    return CoordinateMatrix(coords.rdd.map(lambda c: MatrixEntry(*c)))
+
+
+@contextmanager
+def plain_svo(svo_path: str):
+    """Path of the SVO as plain text, which is all Spark reads:
+    selections and compressed files are copied to a temporary
+    plain file, removed on exit
+    """
+    svo_path = os.path.expanduser(svo_path)
+    if (not svo_io.is_selection(svo_path)
+            and svo_io.codec_of(svo_path) is None):
+        yield svo_path
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        plain_path = os.path.join(directory, 'svo')
+        with svo_io.open_svo(svo_path) as instream:
+            with open(plain_path, 'w') as outstream:
+                shutil.copyfileobj(instream, outstream)
+        yield plain_path
+
+
+def read_svo(svo_path: str):
+    """The plain SVO (see plain_svo) as a DataFrame of its original
+    lines (value), the line order (line) and the parsed
+    s, v, o and n columns
+    """
+    fields = f.split('value', '\t')
+    return (get_spark().read.text(svo_path)
+                       .withColumn('line', f.monotonically_increasing_id())
+                       .select('value', 'line',
+                               fields[0].alias('s'),
+                               fields[1].alias('v'),
+                               fields[2].alias('o'),
+                               fields[3].cast('int').alias('n')))
+
+
+def write_svo(svo_df, svo_path: str):
+    """Writes the original lines of the SVO DataFrame,
+    in their original order, to a single file
+    """
+    parts_dir = svo_path + '_parts'
+    (svo_df.orderBy('line')
+           .select('value')
+           .coalesce(1)
+           .write.text(parts_dir))
+
+    parts = glob.glob(os.path.join(parts_dir, 'part-*'))
+    if parts:
+        shutil.move(parts[0], svo_path)
+    else:
+        open(svo_path, 'w').close()
+    shutil.rmtree(parts_dir)
+
+
+def with_pairs(svo_df):
+    """Adds the (S, O) pair, sorted as pair_left and pair_right,
+    and whether the sentence is in the pair order (rev)
+    """
+    return (svo_df.withColumn('pair_left', f.least('s', 'o'))
+                  .withColumn('pair_right', f.greatest('s', 'o'))
+                  .withColumn('rev', f.col('s') <= f.col('o')))
+
+
+class SparkFilterSentencesByOccurrence(preproc.FilterSentencesByOccurrence):
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, output_dir, svo, **kwargs):
+        with plain_svo(svo) as svo_path:
+            svo_df = read_svo(svo_path)
+            write_svo(svo_df.filter(f.col('n') >= self.min_occurrences),
+                      os.path.join(output_dir, 'svo'))
+
+
+class SparkFilterInstanceInCategory(preproc.FilterInstanceInCategory):
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, output_dir, svo, cat1, cat2, **kwargs):
+        categories_df = f.broadcast(get_spark().createDataFrame(
+            [(instance, instance in cat1, instance in cat2)
+             for instance in cat1 | cat2],
+            'instance string, in_cat1 boolean, in_cat2 boolean'))
+
+        s_categories = categories_df.selectExpr('instance as s',
+                                                'in_cat1 as s_in_cat1',
+                                                'in_cat2 as s_in_cat2')
+        o_categories = categories_df.selectExpr('instance as o',
+                                                'in_cat1 as o_in_cat1',
+                                                'in_cat2 as o_in_cat2')
+
+        condition = f.col('s_in_cat1') & f.col('o_in_cat2')
+        if self.reverse:
+            condition = condition | (f.col('o_in_cat1') & f.col('s_in_cat2'))
+
+        with plain_svo(svo) as svo_path:
+            joined_df = (read_svo(svo_path).join(s_categories, 's')
+                                           .join(o_categories, 'o'))
+            write_svo(joined_df.filter(condition),
+                      os.path.join(output_dir, 'svo'))
+
+
+class SparkMinimumContextOccurrence(preproc.MinimumContextOccurrence):
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, output_dir, svo, **kwargs):
+        occurrences = f.count('*').over(Window.partitionBy('v'))
+        with plain_svo(svo) as svo_path:
+            svo_df = read_svo(svo_path).withColumn('occurrences',
+                                                   occurrences)
+            write_svo(svo_df.filter(f.col('occurrences')
+                                    >= self.minimum_sentences),
+                      os.path.join(output_dir, 'svo'))
+
+
+class SparkMinimumPairOccurrence(preproc.MinimumPairOccurrence):
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, output_dir, svo, **kwargs):
+        occurrences = (f.count('*')
+                        .over(Window.partitionBy('pair_left', 'pair_right')))
+        with plain_svo(svo) as svo_path:
+            svo_df = with_pairs(read_svo(svo_path)).withColumn(
+                'occurrences', occurrences)
+            write_svo(svo_df.filter(f.col('occurrences') >= self.minimum),
+                      os.path.join(output_dir, 'svo'))
+
+
+class SparkSvoToMemory(experiment.SvoToMemory):
+    """Pairs are computed in Spark, the indexes are built locally
+    """
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, svo, **kwargs):
+        pair_to_contexts = defaultdict(list)
+        contexts_to_pairs = defaultdict(list)
+        unique_contexts = set()
+
+        with plain_svo(svo) as svo_path:
+            rows = (with_pairs(read_svo(svo_path))
+                    .orderBy('line')
+                    .select('pair_left', 'pair_right', 'v', 'n', 'rev')
+                    .toLocalIterator())
+
+            for pair_left, pair_right, v, n, rev in rows:
+                pair = (pair_left, pair_right)
+                pair_to_contexts[pair].append((v, n, rev))
+                contexts_to_pairs[v].append((pair, n))
+                unique_contexts.add(v)
+
+        ucontexts_array = np.array(sorted(unique_contexts))
+
+        return {'pair_to_contexts': pair_to_contexts,
+                'contexts_to_pairs': contexts_to_pairs,
+                'unique_contexts': ucontexts_array}
+
+
+def context_cooccurrences(pairs_df):
+    """Number of times each two contexts co-occur within the same
+    (S, O) pair, as (left_verb, right_verb, count) with
+    left_verb <= right_verb (every combination with replacement
+    of the sentences of a pair is a co-occurrence)
+    """
+    left_df = pairs_df.selectExpr('pair_left', 'pair_right',
+                                  'line as left_line', 'v as left_v')
+    right_df = pairs_df.selectExpr('pair_left', 'pair_right',
+                                   'line as right_line', 'v as right_v')
+
+    return (left_df.join(right_df, ['pair_left', 'pair_right'])
+                   .filter('left_line <= right_line')
+                   .select(f.least('left_v', 'right_v').alias('left_verb'),
+                           f.greatest('left_v', 'right_v')
+                            .alias('right_verb'))
+                   .groupby('left_verb', 'right_verb')
+                   .count())
+
+
+class SparkBuildCooccurrenceGraph(ncm.BuildCooccurrenceGraph):
+    """Counts the co-occurrences in Spark from the SVO file,
+    only the weighted edges are collected
+    """
+    def __repr__(self):
+        return 'Spark_' + super().__repr__()
+
+    def apply(self, svo, unique_contexts, **kwargs):
+        cograph = nx.Graph()
+        cograph.add_nodes_from(unique_contexts)
+
+        with plain_svo(svo) as svo_path:
+            edges = context_cooccurrences(with_pairs(read_svo(svo_path)))
+            cograph.add_weighted_edges_from(edges.toLocalIterator())
+
+        logger.info(f'Created cograph,'
+                    f' |V|={cograph.number_of_nodes()}'
+                    f' |E|={cograph.number_of_edges()}'
+                    f' size={cograph.size()}')
+
+        return {'cograph': cograph}
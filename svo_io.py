@@ -0,0 +1,392 @@
+"""Reading and writing SVO files, plain or compressed
+"""
+
+
+import csv
+import gzip
+import io
+import itertools
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+import progress
+
+
+CODEC_EXTENSIONS = {'.gz': 'gzip', '.gzip': 'gzip',
+                    '.zst': 'zstd', '.zstd': 'zstd'}
+CODEC_MAGIC = {b'\x1f\x8b': 'gzip',
+               b'\x28\xb5\x2f\xfd': 'zstd'}
+READ_CHUNK_SIZE = 1 << 20
+LINES_PER_CHUNK = 1 << 18
+SVO_COLUMNS = ['s', 'v', 'o', 'n']
+SELECTION_MAGIC = b'SVO-SELECTION\n'
+SELECTION_THRESHOLD = 0.5
+
+
+Selection = namedtuple('Selection', ['path', 'bitmap'])
+
+
+logger = logging.getLogger(__name__)
+
+
+def codec_of(path, mode='r'):
+    """Codec of the file: from its extension or,
+    for existing files without a known extension, its first bytes.
+
+    None for plain text
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in CODEC_EXTENSIONS:
+        return CODEC_EXTENSIONS[extension]
+
+    if mode == 'r':
+        with open(path, 'rb') as svo:
+            head = svo.read(4)
+        for magic, codec in CODEC_MAGIC.items():
+            if head.startswith(magic):
+                return codec
+
+    return None
+
+
+def open_svo(path, mode='r', compression=None, level=None):
+    """Opens an SVO file as text, in mode 'r' or 'w'.
+
+    Selection files (see write_filtered) are read as the selected
+    lines of their physical file.
+
+    The codec ('gzip', 'zstd' or None) is the given compression,
+    else the one of the file (see codec_of). Compressed files are
+    decompressed in a background thread, while the caller parses;
+    zstd files are compressed with all cores
+    """
+    if mode not in ('r', 'w'):
+        raise ValueError(f'Unsupported mode {mode}')
+
+    path = os.path.expanduser(path)
+    if mode == 'r' and is_selection(path):
+        return SelectedLines(read_selection(path))
+
+    if compression is None:
+        compression = codec_of(path, mode)
+    if compression not in (None, 'gzip', 'zstd'):
+        raise ValueError(f'Unknown compression {compression}')
+
+    if compression is None:
+        return open(path, mode)
+    logger.debug(f'Opening {path} ({compression}) in mode {mode}')
+
+    if mode == 'r':
+        if compression == 'gzip':
+            raw = gzip.open(path, 'rb')
+        else:
+            raw = _zstandard().ZstdDecompressor().stream_reader(
+                open(path, 'rb'), read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(io.BufferedReader(PrefetchReader(raw)))
+
+    if compression == 'gzip':
+        return io.TextIOWrapper(gzip.open(path, 'wb',
+                                          compresslevel=level or 6))
+
+    compressor = _zstandard().ZstdCompressor(level=level or 3, threads=-1)
+    return io.TextIOWrapper(compressor.stream_writer(open(path, 'wb'),
+                                                     closefd=True))
+
+
+def read_chunks(path, chunk_size=LINES_PER_CHUNK):
+    """The SVO in chunks of up to chunk_size lines, parsed by
+    the pandas C parser. Each chunk is a tuple of the columns
+    (s, v, o, n): object arrays of strings, and n as int64
+    """
+    # pandas takes a while to import, so only readers load it
+    import pandas as pd
+
+    with open_svo(path) as svo:
+        chunks = pd.read_csv(svo, sep='\t', header=None, names=SVO_COLUMNS,
+                             dtype={'s': object, 'v': object,
+                                    'o': object, 'n': np.int64},
+                             quoting=csv.QUOTE_NONE, na_filter=False,
+                             engine='c', chunksize=chunk_size)
+        for chunk in chunks:
+            progress.tick(len(chunk), 'lines')
+            yield tuple(chunk[column].to_numpy() for column in SVO_COLUMNS)
+
+
+def estimate_lines(path):
+    """Number of lines in the SVO: exact for selections and
+    compressed files (which are read through), else extrapolated
+    from the length of the lines in the first READ_CHUNK_SIZE bytes
+    """
+    path = os.path.expanduser(path)
+    if is_selection(path):
+        return int(read_selection(path).bitmap.sum())
+
+    if codec_of(path) is not None:
+        with open_svo(path) as svo:
+            return sum(block.count('\n')
+                       for block in iter(lambda: svo.read(READ_CHUNK_SIZE),
+                                         ''))
+
+    with open(path, 'rb') as svo:
+        head = svo.read(READ_CHUNK_SIZE)
+    size = os.path.getsize(path)
+    if not head:
+        return 0
+    if len(head) == size:
+        return head.count(b'\n')
+    return int(size * head.count(b'\n') / len(head))
+
+
+def isin(column, instances):
+    """Vectorised membership: boolean array of which
+    values of the column are in the set of instances
+    """
+    import pandas as pd
+
+    return pd.Series(column).isin(instances).to_numpy()
+
+
+def is_selection(path):
+    with open(path, 'rb') as svo:
+        return svo.read(len(SELECTION_MAGIC)) == SELECTION_MAGIC
+
+
+def is_available(path):
+    """Whether the file exists and, for selections,
+    whether their physical file exists too
+    """
+    if not os.path.exists(path):
+        return False
+    if os.path.isfile(path) and is_selection(path):
+        with open(path, 'rb') as selection:
+            selection.readline()
+            physical_path = selection.readline().decode().rstrip('\n')
+        return os.path.exists(physical_path)
+    return True
+
+
+def read_selection(path):
+    """The Selection stored in the file: the physical SVO file
+    and the boolean array of which of its lines are selected
+    """
+    with open(path, 'rb') as selection:
+        selection.readline()
+        physical_path = selection.readline().decode().rstrip('\n')
+        rows = int(selection.readline())
+        bitmap = np.unpackbits(np.frombuffer(selection.read(), dtype=np.uint8),
+                               count=rows).astype(bool)
+    return Selection(physical_path, bitmap)
+
+
+def write_selection(path, selection):
+    with open(path, 'wb') as output:
+        output.write(SELECTION_MAGIC)
+        output.write(f'{selection.path}\n{len(selection.bitmap)}\n'.encode())
+        output.write(np.packbits(selection.bitmap).tobytes())
+
+
+def write_filtered(svo, output_path, kept_chunks, compression=None,
+                   threshold=SELECTION_THRESHOLD):
+    """Writes the lines of svo kept by a filter to output_path,
+    in the same pass that decides them: kept_chunks yields,
+    for each chunk of svo in order (see read_chunks),
+    its columns and the boolean array of which lines to keep.
+    Returns the boolean array of the kept lines of svo.
+
+    When at least a threshold fraction of the lines is kept,
+    a selection file (a bitmap over the lines of the physical file)
+    is written instead of a copy. A selection of a selection
+    refers to the same physical file, so a chain of filters
+    keeps a single copy of the SVO, which must not be removed
+    while selections over it are in use.
+
+    The copy is written as the chunks come, and given up once
+    more lines are kept than a copy would have (from the number
+    of lines of svo, known for selections and estimated for plain
+    files; compressed files are copied to the end). A threshold
+    of None always copies
+    """
+    copy_limit = None
+    if threshold is not None and codec_of(svo) is None:
+        copy_limit = threshold * estimate_lines(svo)
+
+    keeps = []
+    kept = 0
+    outstream = open_svo(output_path, 'w', compression=compression)
+    try:
+        for columns, keep in kept_chunks:
+            keep = np.asarray(keep, dtype=bool)
+            keeps.append(keep)
+            kept += int(keep.sum())
+            if outstream is None:
+                continue
+            if copy_limit is not None and kept > copy_limit:
+                outstream.close()
+                outstream = None
+                os.remove(output_path)
+                continue
+            outstream.writelines(f'{s}\t{v}\t{o}\t{n}\n'
+                                 for s, v, o, n in zip(*(column[keep]
+                                                         for column
+                                                         in columns)))
+    finally:
+        if outstream is not None:
+            outstream.close()
+
+    keep = np.concatenate(keeps) if keeps else np.empty(0, dtype=bool)
+    kept_fraction = kept / len(keep) if len(keep) else 1.0
+
+    if threshold is None or kept_fraction < threshold:
+        if outstream is None:
+            # the estimate was off: copying takes another pass
+            logger.debug(f'Copying {kept} of {len(keep)} lines'
+                         f' to {output_path} again')
+            _copy_lines(svo, output_path, keep, compression)
+        else:
+            logger.debug(f'Copied {kept} of {len(keep)} lines'
+                         f' to {output_path}')
+        return keep
+
+    if is_selection(svo):
+        upstream = read_selection(svo)
+        bitmap = np.zeros_like(upstream.bitmap)
+        bitmap[np.flatnonzero(upstream.bitmap)[keep]] = True
+        selection = Selection(upstream.path, bitmap)
+    else:
+        selection = Selection(os.path.realpath(svo), keep)
+
+    logger.debug(f'Selecting {kept} of {len(keep)} lines'
+                 f' of {selection.path} in {output_path}')
+    write_selection(output_path, selection)
+    return keep
+
+
+def _copy_lines(svo, output_path, keep, compression=None):
+    """Copies the lines of svo selected by the boolean array keep
+    """
+    with open_svo(svo, 'r') as instream:
+        with open_svo(output_path, 'w',
+                      compression=compression) as outstream:
+            outstream.writelines(itertools.compress(instream,
+                                                    _selectors(keep)))
+
+
+def _selectors(bitmap, chunk_size=READ_CHUNK_SIZE):
+    """The bitmap as Python booleans, converted a chunk at a time
+    """
+    for start in range(0, len(bitmap), chunk_size):
+        yield from bitmap[start:start + chunk_size].tolist()
+
+
+class SelectedLines:
+    """Text-file-like reader of the selected lines of a Selection
+    """
+    def __init__(self, selection):
+        self._physical = open_svo(selection.path)
+        self._lines = itertools.compress(self._physical,
+                                         _selectors(selection.bitmap))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    def read(self, size=-1):
+        """Whole lines, at least size characters of them
+        (all of them for a negative size)
+        """
+        if size is None or size < 0:
+            return ''.join(self._lines)
+
+        lines = []
+        read = 0
+        for line in self._lines:
+            lines.append(line)
+            read += len(line)
+            if read >= size:
+                break
+        return ''.join(lines)
+
+    def close(self):
+        self._physical.close()
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('zstd compressed SVO files'
+                          ' need the zstandard package') from e
+    return zstandard
+
+
+class PrefetchReader(io.RawIOBase):
+    """Reads a binary stream ahead in a background thread,
+    so decompression (which releases the GIL) overlaps
+    with the processing of the previous chunks
+    """
+    def __init__(self, stream, chunk_size=READ_CHUNK_SIZE, depth=4):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._chunks = queue.Queue(depth)
+        self._stopped = threading.Event()
+        self._current = memoryview(b'')
+        self._exhausted = False
+        self._reader = threading.Thread(target=self._read_ahead, daemon=True)
+        self._reader.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._current and not self._exhausted:
+            chunk = self._chunks.get()
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if not chunk:
+                self._exhausted = True
+            self._current = memoryview(chunk)
+
+        size = min(len(buffer), len(self._current))
+        buffer[:size] = self._current[:size]
+        self._current = self._current[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stopped.set()
+            self._reader.join()
+            self._stream.close()
+        super().close()
+
+    def _read_ahead(self):
+        try:
+            while True:
+                chunk = self._stream.read(self._chunk_size)
+                if not self._put(chunk) or not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        """Waits for room in the queue, unless reading was stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False